@@ -31,6 +31,7 @@ import importlib
 # noinspection PyUnresolvedReferences
 from bpy.props import (
     BoolProperty,
+    EnumProperty,
     FloatVectorProperty,
     IntProperty,
     FloatProperty,
@@ -42,8 +43,19 @@ from bpy.types import (
     Menu
 )
 from bpy_extras.object_utils import AddObjectHelper, object_data_add
+from . import sl_cache
+from . import sl_skeleton_table
 from . import sl_skeleton
+from . import sl_lad
+from . import sl_shape
+from . import sl_params
+from . import sl_genepool
+from . import sl_mesh
+from . import sl_morph
 from . import sl_avatar
+from . import puppetry_framing
+from . import puppetry_io
+from . import puppetry_pose
 from . import puppetry
 from . import tools
 
@@ -66,6 +78,31 @@ class OBJECT_OT_add_secondlife_skeleton(Operator, AddObjectHelper):
         sl_skeleton.add_skeleton(self, context)
         return {'FINISHED'}
 
+class OBJECT_OT_add_secondlife_skeletons(Operator):
+    """Create many Second Life skeletons in a grid"""
+    bl_idname = "add.secondlife_skeletons"
+    bl_label = "Skeleton Grid"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    count: IntProperty(
+        name="Count",
+        default=16,
+        min=1,
+        soft_max=1024,
+        description="Number of rigs to add",
+    )
+    spacing: FloatProperty(
+        name="Spacing",
+        default=1.0,
+        min=0.0,
+        subtype='DISTANCE',
+        description="Distance between neighbouring rigs",
+    )
+
+    def execute(self, context):
+        sl_skeleton.add_skeletons(context, self.count, self.spacing, context.scene.cursor.location.copy())
+        return {'FINISHED'}
+
 ##Avatar
 class OBJECT_OT_add_secondlife_avatar(Operator, AddObjectHelper):
     """Create a new Mesh Object"""
@@ -73,9 +110,66 @@ class OBJECT_OT_add_secondlife_avatar(Operator, AddObjectHelper):
     bl_label = "Avatar"
     bl_options = {'REGISTER', 'UNDO'}
 
+    shared: BoolProperty(
+        name="Share Meshes",
+        default=False,
+        description="Link the body parts to shared mesh data, copied when edited",
+    )
+
     def execute(self, context):
         arm, bone_matrix = sl_skeleton.add_skeleton(self, context)
-        meshes = sl_avatar.attachMeshesToArmature(arm)
+        meshes = sl_avatar.attachMeshesToArmature(arm, shared=self.shared)
+        return {'FINISHED'}
+
+class OBJECT_OT_add_secondlife_avatars(Operator):
+    """Create many Second Life avatars shaped from genepool.xml archetypes"""
+    bl_idname = "add.secondlife_avatars"
+    bl_label = "Avatar Batch"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    mode: EnumProperty(
+        name="Mode",
+        items=(
+            ("ARCHETYPES", "Archetypes", "One avatar per archetype, repeated until the count is reached"),
+            ("BLENDS", "Random Blends", "Random mixes of the archetypes"),
+        ),
+        default="ARCHETYPES",
+    )
+    count: IntProperty(
+        name="Count",
+        default=24,
+        min=1,
+        soft_max=512,
+        description="Number of avatars to add",
+    )
+    parents: IntProperty(
+        name="Archetypes per Blend",
+        default=2,
+        min=1,
+        max=24,
+        description="Number of archetypes mixed into each random blend",
+    )
+    seed: IntProperty(
+        name="Seed",
+        default=0,
+        min=0,
+        description="Seed for the random blends",
+    )
+    spacing: FloatProperty(
+        name="Spacing",
+        default=1.0,
+        min=0.0,
+        subtype='DISTANCE',
+        description="Distance between neighbouring avatars",
+    )
+
+    def execute(self, context):
+        if self.mode == "BLENDS":
+            values = sl_genepool.randomBlends(self.count, parents=self.parents, seed=self.seed)
+        else:
+            names = list(sl_genepool.loadGenepool().keys())
+            values = sl_genepool.archetypeValues([names[i % len(names)] for i in range(self.count)])
+        sl_avatar.addAvatars(context, values, self.spacing, context.scene.cursor.location.copy())
         return {'FINISHED'}
 
 
@@ -88,13 +182,17 @@ class VIEW3D_MT_secondlife_menu(Menu):
     def draw(self, context):
         self.layout.operator_context = 'INVOKE_REGION_WIN'
         self.layout.operator(OBJECT_OT_add_secondlife_skeleton.bl_idname, text="Skeleton", icon="ARMATURE_DATA")
+        self.layout.operator(OBJECT_OT_add_secondlife_skeletons.bl_idname, text="Skeleton Grid", icon="ARMATURE_DATA")
         self.layout.operator(OBJECT_OT_add_secondlife_avatar.bl_idname, text="Avatar", icon="OUTLINER_OB_ARMATURE")
+        self.layout.operator(OBJECT_OT_add_secondlife_avatars.bl_idname, text="Avatar Batch", icon="OUTLINER_OB_ARMATURE")
         #self.layout.separator()
 
 module_classes = (
     VIEW3D_MT_secondlife_menu,
     OBJECT_OT_add_secondlife_skeleton,
+    OBJECT_OT_add_secondlife_skeletons,
     OBJECT_OT_add_secondlife_avatar,
+    OBJECT_OT_add_secondlife_avatars,
 )
 
 def add_secondlife_menu_func(self, context):
@@ -102,8 +200,19 @@ def add_secondlife_menu_func(self, context):
     layout.separator()
     self.layout.menu(VIEW3D_MT_secondlife_menu.bl_idname, icon="VIEW_PAN")
 
+importlib.reload(sl_cache)
+importlib.reload(sl_skeleton_table)
 importlib.reload(sl_skeleton)
+importlib.reload(sl_lad)
+importlib.reload(sl_shape)
+importlib.reload(sl_params)
+importlib.reload(sl_genepool)
+importlib.reload(sl_mesh)
+importlib.reload(sl_morph)
 importlib.reload(sl_avatar)
+importlib.reload(puppetry_framing)
+importlib.reload(puppetry_io)
+importlib.reload(puppetry_pose)
 importlib.reload(puppetry)
 importlib.reload(tools)
 
@@ -7,10 +7,10 @@ import bpy.props
 from bpy_extras.object_utils import AddObjectHelper, object_data_add
 from mathutils import Vector
 import llbase.llsd
-import socket
-import errno
 import time
-from . import sl_skeleton
+from . import sl_skeleton_table
+from .puppetry_io import PuppetryConnection, CONNECTED, FRAME, CLOSED
+from .puppetry_pose import PoseExtractor, PoseDeltaEncoder, compileTransmitMask
 
 Global = {}
 
@@ -22,33 +22,46 @@ class PuppetrySession:
         self.connected = False
         self.shouldClose = False
         self.pump = None
-        self.buffer = b""
-        self.length = None
-        self.sock = None
-        self.last = {}
-        self.lastUpdate = 0
+        self.connection = None
+        self.extractor = None
+        self.transmitMask = None
+        self.encoder = PoseDeltaEncoder()
         bpy.app.timers.register(self.timer)
         bpy.app.timers.register(self.animate)
     
     def setProps(self, props):
         self.props = props
     
+    def invalidateTransmit(self):
+        #Called whenever the Transmit list changes, animate recompiles the mask
+        self.transmitMask = None
+    
+    def checkLayout(self):
+        #Called when armature data changed, animate only compares pointers
+        if self.extractor is None or self.props is None:
+            return
+        arm = bpy.data.objects.get(self.props.Target)
+        if arm is None or arm.type != 'ARMATURE' or not self.extractor.layoutMatches(arm):
+            self.extractor = None
+            self.transmitMask = None
+    
     def connect(self, host, port):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.settimeout(1)
-        self.sock.connect((host, port))
-        self.sock.settimeout(0.1)
-        self.connected = True
+        #Connecting happens on the I/O thread, timer picks up the result
+        if self.connection is not None:
+            return
+        self.pump = None
+        self.connection = PuppetryConnection(host, port).start()
     
-    def send(self, pump, data):
+    def send(self, pump, data, pose = False):
         if self.connected == False:
             return
         if not self.pump:
             return
         data = llbase.llsd.format_notation({"pump": pump, "data": data})
-        data = str(len(data)).encode()+b":"+data
         print(data)
-        return self.sock.sendall(data)
+        if pose:
+            return self.connection.sendPose(data)
+        return self.connection.send(data)
     
     def handleData(self, data):
         data = llbase.llsd.parse_notation(data)
@@ -78,10 +91,6 @@ class PuppetrySession:
         if data["pump"] == "puppetry.controller":
             pass
     
-    def recv(self, size):
-        self.sock.settimeout(0)
-        return self.sock.recv(size)
-    
     def animate(self):
         if self.shouldClose:
             return None
@@ -93,115 +102,70 @@ class PuppetrySession:
             return 1
         
         arm = bpy.data.objects[self.props.Target]
+        if self.extractor is None or not self.extractor.matches(arm):
+            self.extractor = PoseExtractor(arm)
+            self.transmitMask = None
         
-        updates = {}
-        shouldUpdate = False
-        for bn in arm.data.bones.keys():
-            if bn not in self.props.Transmit:
-                continue
-            
-            if not (self.props.Transmit[bn].position \
-             or self.props.Transmit[bn].rotation):
-                continue
-            
-            db = arm.data.bones[bn]
-            pb = arm.pose.bones[bn]
-            
-            mat = pb.matrix_channel
-            if pb.parent:
-                mat = pb.parent.matrix_channel.inverted() @ mat
-            
-            r = mat.to_3x3().to_quaternion()
-            
-            r.normalize()
-            
-            if r.w < 0:
-                r = r.inverted()
-            
-            loc, rot, scale = mat.decompose()
-            
-            if bn not in updates:
-                updates[bn] = {}
-            
-            if self.props.Transmit[bn].rotation:
-                updates[bn]["r"] = [
-                    r.x,
-                    r.y,
-                    r.z,
-                ]
-            
-            if self.props.Transmit[bn].position:
-                updates[bn]["p"] = [
-                    loc.x,
-                    loc.y,
-                    loc.z,
-                ]
-            
-            if bn not in self.last:
-                shouldUpdate = True
-            else:
-                for check in updates[bn].keys():
-                    if check not in self.last[bn]:
-                        shouldUpdate = True
-                    elif self.last[bn][check] != updates[bn][check]:
-                        shouldUpdate = True
-                        
-                for check in self.last[bn].keys():
-                    if check not in updates[bn]:
-                        shouldUpdate = True
+        #Read Transmit once here instead of on every tick
+        if self.transmitMask is None:
+            self.transmitMask = compileTransmitMask(self.extractor.names,
+                {t.name:(t.position, t.rotation) for t in self.props.Transmit})
+        mask = self.transmitMask
         
-        now = time.time()
-        if shouldUpdate or now > self.lastUpdate + 0.5:
-            self.last = updates
-            self.lastUpdate = now
-            self.send("puppetry", {
+        rotations, positions = self.extractor.extract(arm, mask.indices)
+        
+        self.encoder.angle = math.radians(self.props.AngleThreshold)
+        self.encoder.distance = self.props.PositionThreshold
+        self.encoder.precision = self.props.Precision
+        self.encoder.keyframeInterval = self.props.KeyframeTime
+        updates = self.encoder.encode(mask, rotations, positions, time.time())
+        if updates:
+            #A delta that replaced one the viewer never got leaves joints
+            #behind, the next tick sends everything
+            dropped = self.send("puppetry", {
                 "command": "set",
                 "reply": None,
                 "data": {
                     #Could also use "joint_state" instead of "j"
                     "j": updates
                 }
-            })
+            }, pose=True)
+            if dropped:
+                self.encoder.forceKeyframe()
         return self.props.UpdateTime
     
     def timer(self):
         if self.shouldClose:
             return 0
-        if not self.connected:
+        if self.connection is None:
             return 1
-        try:
-            while self.connected:
-                c = self.recv(1)
-                if c == None or c == b"":
-                    print("NO DATA")
-                    self.disconnect()
-                    break
-                if self.length == None:
-                    if c == b":":
-                        self.length = int(self.buffer)
-                        self.buffer = b""
-                    else:
-                        self.buffer += c
-                    continue
-                
-                self.buffer += c
-                if len(self.buffer) == self.length:
-                    self.handleData(self.buffer)
-                    self.buffer = b""
-                    self.length = None
-        except socket.error as e:
-            err = e.args[0]
-            if err == errno.EAGAIN or err == errno.EWOULDBLOCK:
-                pass
-            else:
-                raise e
+        for event, value in self.connection.events():
+            if event == CONNECTED:
+                self.connected = True
+                self.redraw()
+            elif event == FRAME:
+                self.handleData(value)
+            elif event == CLOSED:
+                if value:
+                    print("Puppetry connection closed:", value)
+                self.disconnect()
+                break
         return 0.01
     
     def disconnect(self):
         self.connected = False
-        if self.sock:
-            self.sock.close()
-        self.sock = None
+        self.encoder.reset()
+        if self.connection:
+            self.connection.close(timeout=0)
+            self.redraw()
+        self.connection = None
+    
+    def redraw(self):
+        #The connect button is labelled from the connection state
+        for window in bpy.context.window_manager.windows:
+            for area in window.screen.areas:
+                if area.type == 'VIEW_3D':
+                    area.tag_redraw()
     
     def close(self):
         self.shouldClose = True
@@ -211,9 +175,13 @@ class PuppetrySession:
 # Blender Operator class
 #==============================================================================
 #Custom types
+def transmitChanged(self, context):
+    if "Session" in Global:
+        Global["Session"].invalidateTransmit()
+
 class PuppetryTransmitList(bpy.types.PropertyGroup):
-    position: bpy.props.IntProperty(name="A")
-    rotation: bpy.props.IntProperty(name="B")
+    position: bpy.props.IntProperty(name="A", update=transmitChanged)
+    rotation: bpy.props.IntProperty(name="B", update=transmitChanged)
     group: bpy.props.StringProperty()
 
 class StringArrayProperty(bpy.types.PropertyGroup):
@@ -230,7 +198,8 @@ class VIEW3D_OT_puppetry_connect(bpy.types.Operator):
         layout = self.layout
         scene = context.scene
         props = scene.puppetry
-        if Session.connected:
+        #A connection still being made counts as connected here
+        if Session.connection is not None:
             Session.disconnect()
         else:
             Session.connect(props.Host, port=props.Port)
@@ -269,6 +238,40 @@ class PuppetryProperties(bpy.types.PropertyGroup):
         min = 0.05,
         max = 5
     )
+    
+    KeyframeTime: bpy.props.FloatProperty(
+        name = "Keyframe rate",
+        description = "Seconds between full updates of every joint",
+        default = 0.5,
+        min = 0.05,
+        max = 30
+    )
+    
+    AngleThreshold: bpy.props.FloatProperty(
+        name = "Angle threshold",
+        description = "Degrees a joint has to turn before it is sent again",
+        default = 0.25,
+        min = 0,
+        max = 45
+    )
+    
+    PositionThreshold: bpy.props.FloatProperty(
+        name = "Position threshold",
+        description = "Distance a joint has to move before it is sent again",
+        default = 0.0005,
+        min = 0,
+        max = 1,
+        precision = 4,
+        subtype = 'DISTANCE'
+    )
+    
+    Precision: bpy.props.IntProperty(
+        name = "Precision",
+        description = "Decimal places sent for rotations and positions",
+        default = 4,
+        min = 1,
+        max = 8
+    )
 
 class VIEW3D_PT_puppetry_connect(bpy.types.Panel):
     bl_space_type = 'VIEW_3D'
@@ -287,15 +290,21 @@ class VIEW3D_PT_puppetry_connect(bpy.types.Panel):
         layout.prop(props, "Host")
         layout.prop(props, "Port")
         layout.separator()
+        #Same check as the operator, a connection still being made can be cancelled
         if Session.connected:
             layout.operator('puppetry.connect', text = 'Disconnect')
+        elif Session.connection is not None:
+            layout.operator('puppetry.connect', text = 'Cancel')
         else:
             layout.operator('puppetry.connect', text = 'Connect')
 
 #Armature submenu
 @bpy.app.handlers.persistent
-def findArmatures(self):
+def findArmatures(scene, depsgraph = None):
     findArmaturesReal()
+    #Renamed or reparented bones come with an armature data update
+    if depsgraph is None or depsgraph.id_type_updated('ARMATURE'):
+        Global["Session"].checkLayout()
 
 def findArmaturesReal():
     context = bpy.context
@@ -350,6 +359,10 @@ class VIEW3D_PT_puppetry_armature(bpy.types.Panel):
         layout.prop_search(props, "Target", props, "Armatures", text="", icon="ARMATURE_DATA")
         layout.separator()
         layout.prop(props, "UpdateTime")
+        layout.prop(props, "KeyframeTime")
+        layout.prop(props, "AngleThreshold")
+        layout.prop(props, "PositionThreshold")
+        layout.prop(props, "Precision")
         row = layout.row()
         """
         row = layout.row(align=True)
@@ -403,6 +416,7 @@ class VIEW3D_OT_puppetry_transmit_toggle(bpy.types.Operator):
                     setattr(p, self.property, not getattr(p, self.property))
                 else:
                     setattr(p, self.property, bool(self.value))
+        Global["Session"].invalidateTransmit()
         return {'FINISHED'}
 
 class VIEW3D_UL_puppetry_transmit(bpy.types.UIList):
@@ -533,16 +547,19 @@ def populateBoneList():
     transmit.clear()
     groups.clear()
     
-    bones = sl_skeleton.get_skeleton()
+    bones = sl_skeleton_table.loadSkeleton()
     addedGroups = []
     for bone in bones:
-        if bone["group"] not in addedGroups:
-            addedGroups.append(bone["group"])
+        if bone.group not in addedGroups:
+            addedGroups.append(bone.group)
             g = groups.add()
-            g.name = bone["group"].capitalize()
+            g.name = bone.group.capitalize()
         b = transmit.add()
-        b.name = bone["name"]
-        b.group = bone["group"]
+        b.name = bone.name
+        b.group = bone.group
+    
+    if "Session" in Global:
+        Global["Session"].invalidateTransmit()
 
 #Registration
 
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+#The puppetry plugin protocol frames every message as b"<length>:<payload>"
+
+CHUNK_SIZE = 64 * 1024
+MAX_FRAME = 16 * 1024 * 1024
+MAX_HEADER = 20
+
+class FramingError(Exception):
+    pass
+
+def encodeFrame(payload):
+    return str(len(payload)).encode() + b":" + payload
+
+class FrameDecoder:
+    #Incremental decoder, bytes go into one reusable buffer and every complete
+    #frame is taken out of it without copying the rest around
+    #Unconsumed data lives in buffer[start:end], length is the size of the
+    #frame whose header has been read, None while waiting for a header
+    __slots__ = ("buffer", "start", "end", "length", "chunkSize", "maxFrame")
+    
+    def __init__(self, chunkSize = CHUNK_SIZE, maxFrame = MAX_FRAME):
+        self.buffer = bytearray(chunkSize)
+        self.start = 0
+        self.end = 0
+        self.length = None
+        self.chunkSize = chunkSize
+        self.maxFrame = maxFrame
+    
+    def __len__(self):
+        return self.end - self.start
+    
+    def reserve(self, size):
+        #Makes room for size more bytes, compacting before growing
+        if len(self.buffer) - self.end >= size:
+            return
+        pending = self.end - self.start
+        if self.start:
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.start = 0
+            self.end = pending
+        if len(self.buffer) - self.end < size:
+            self.buffer.extend(bytes(size - (len(self.buffer) - self.end)))
+    
+    def feed(self, data):
+        self.reserve(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+    
+    def readFrom(self, sock):
+        #One recv_into straight into the buffer, returns the byte count,
+        #0 once the peer has closed, socket errors are left to the caller
+        self.reserve(self.chunkSize)
+        with memoryview(self.buffer) as view:
+            count = sock.recv_into(view[self.end:self.end + self.chunkSize])
+        self.end += count
+        return count
+    
+    def frames(self):
+        #Every complete payload in the buffer, in order
+        result = []
+        buffer = self.buffer
+        while True:
+            if self.length is None:
+                colon = buffer.find(b":", self.start, min(self.end, self.start + MAX_HEADER + 1))
+                if colon < 0:
+                    if self.end - self.start > MAX_HEADER:
+                        raise FramingError("No frame length in {!r}".format(bytes(buffer[self.start:self.start + MAX_HEADER])))
+                    break
+                header = buffer[self.start:colon]
+                if not header.isdigit():
+                    raise FramingError("Bad frame length {!r}".format(bytes(header)))
+                self.length = int(header)
+                if self.length > self.maxFrame:
+                    raise FramingError("Frame of {} bytes is over the {} byte limit".format(self.length, self.maxFrame))
+                self.start = colon + 1
+            
+            if self.end - self.start < self.length:
+                #Make sure the rest of a large frame fits in one go
+                self.reserve(self.length - (self.end - self.start))
+                buffer = self.buffer
+                break
+            result.append(bytes(buffer[self.start:self.start + self.length]))
+            self.start += self.length
+            self.length = None
+        
+        if self.start == self.end:
+            self.start = self.end = 0
+        return result
+    
+    def reset(self):
+        self.start = 0
+        self.end = 0
+        self.length = None
+
+if __name__ == "__main__":
+    import os
+    import time
+    import random
+    import socket
+    
+    payloads = [os.urandom(random.randrange(0, 300000)) for i in range(50)] + [b""] * 3
+    stream = b"".join(encodeFrame(p) for p in payloads)
+    
+    #Any split of the stream decodes to the same frames
+    for step in (7, 4096, CHUNK_SIZE, len(stream)):
+        decoder = FrameDecoder()
+        decoded = []
+        for i in range(0, len(stream), step):
+            decoder.feed(stream[i:i + step])
+            decoded += decoder.frames()
+        assert decoded == payloads, step
+        assert len(decoder) == 0
+    
+    for bad in (b"12a:xx", b"9" * 30):
+        try:
+            decoder = FrameDecoder()
+            decoder.feed(bad)
+            decoder.frames()
+        except FramingError:
+            pass
+        else:
+            raise AssertionError(bad)
+    
+    #Straight from a socket
+    a, b = socket.socketpair()
+    a.setblocking(False)
+    b.setblocking(False)
+    decoder = FrameDecoder()
+    decoded = []
+    sent = 0
+    start = time.perf_counter()
+    while len(decoded) < len(payloads):
+        try:
+            sent += a.send(stream[sent:sent + CHUNK_SIZE * 4])
+        except BlockingIOError:
+            pass
+        try:
+            decoder.readFrom(b)
+        except BlockingIOError:
+            pass
+        decoded += decoder.frames()
+    assert decoded == payloads
+    print("{:.1f} MiB decoded in {:.1f}ms".format(len(stream) / 2 ** 20, (time.perf_counter() - start) * 1000))
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+import queue
+import select
+import socket
+import threading
+from .puppetry_framing import FrameDecoder, encodeFrame
+
+CONNECT_TIMEOUT = 1.0
+IDLE_TIMEOUT = 0.5
+OUTBOX_SIZE = 256
+
+#Events the worker hands to the main thread, see PuppetryConnection.events
+CONNECTED = "connected"
+FRAME = "frame"
+CLOSED = "closed"
+
+class PuppetryConnection:
+    #Owns the socket on a worker thread so Blender's main thread never waits
+    #on the network
+    #Outgoing messages go through a bounded queue, pose updates through a
+    #single slot where a newer pose replaces one that was not sent yet, so a
+    #slow viewer gets fewer poses instead of stalling Blender
+    #Incoming frames and connection changes come back through events()
+    def __init__(self, host, port):
+        self.address = (host, port)
+        self.inbox = queue.SimpleQueue()
+        self.outbox = queue.Queue(OUTBOX_SIZE)
+        self.pose = None
+        self.poseLock = threading.Lock()
+        self.stopping = threading.Event()
+        self.waker, self.wakee = socket.socketpair()
+        self.waker.setblocking(False)
+        self.wakee.setblocking(False)
+        self.thread = threading.Thread(target=self.run, name="Puppetry I/O", daemon=True)
+    
+    def start(self):
+        self.thread.start()
+        return self
+    
+    def wake(self):
+        try:
+            self.waker.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass
+    
+    def send(self, payload):
+        #Queues one message, False if the queue is full and it was dropped
+        try:
+            self.outbox.put_nowait(encodeFrame(payload))
+        except queue.Full:
+            return False
+        self.wake()
+        return True
+    
+    def sendPose(self, payload):
+        #Replaces any pose still waiting to go out, True if one was
+        with self.poseLock:
+            replaced = self.pose is not None
+            self.pose = encodeFrame(payload)
+        self.wake()
+        return replaced
+    
+    def events(self):
+        #Everything that arrived since the last call, as (event, value) pairs
+        result = []
+        while True:
+            try:
+                result.append(self.inbox.get_nowait())
+            except queue.Empty:
+                return result
+    
+    def close(self, timeout = 1.0):
+        self.stopping.set()
+        self.wake()
+        if self.thread.is_alive() and self.thread is not threading.current_thread():
+            self.thread.join(timeout)
+    
+    def nextMessage(self):
+        #Queued messages go before the pose, they are usually replies
+        try:
+            return memoryview(self.outbox.get_nowait())
+        except queue.Empty:
+            pass
+        with self.poseLock:
+            pose, self.pose = self.pose, None
+        return memoryview(pose) if pose is not None else None
+    
+    def run(self):
+        try:
+            sock = socket.create_connection(self.address, timeout=CONNECT_TIMEOUT)
+        except OSError as e:
+            self.inbox.put((CLOSED, e))
+            self.cleanup(None)
+            return
+        
+        sock.setblocking(False)
+        self.inbox.put((CONNECTED, None))
+        decoder = FrameDecoder()
+        pending = None
+        reason = None
+        try:
+            while not self.stopping.is_set():
+                if pending is None:
+                    pending = self.nextMessage()
+                
+                readable, writable, _ = select.select(
+                    [sock, self.wakee], [sock] if pending is not None else [], [], IDLE_TIMEOUT)
+                
+                if self.wakee in readable:
+                    try:
+                        while self.wakee.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                
+                if sock in readable:
+                    try:
+                        while True:
+                            if decoder.readFrom(sock) == 0:
+                                reason = "Connection closed by peer"
+                                return
+                            for frame in decoder.frames():
+                                self.inbox.put((FRAME, frame))
+                    except BlockingIOError:
+                        pass
+                
+                if sock in writable and pending is not None:
+                    try:
+                        sent = sock.send(pending)
+                    except BlockingIOError:
+                        sent = 0
+                    pending = pending[sent:] if sent < len(pending) else None
+        except Exception as e:
+            reason = e
+        finally:
+            self.inbox.put((CLOSED, reason))
+            self.cleanup(sock)
+    
+    def cleanup(self, sock):
+        if sock is not None:
+            sock.close()
+        self.waker.close()
+        self.wakee.close()
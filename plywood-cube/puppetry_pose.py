@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+import collections
+import numpy as np
+
+def matricesToQuaternions(matrices):
+    #Rotation parts of (..., 3, 3) matrices to unit (..., 4) w, x, y, z
+    #quaternions with w >= 0, scale is divided out of the columns first
+    m = matrices / np.linalg.norm(matrices, axis=-2, keepdims=True)
+    m00, m11, m22 = m[..., 0, 0], m[..., 1, 1], m[..., 2, 2]
+    
+    #Shepperd's method, row k is 4 * q[k] * q, taken from the row with the
+    #largest diagonal so it never divides by a small component
+    rows = np.empty(m.shape[:-2] + (4, 4))
+    rows[..., 0, 0] = 1 + m00 + m11 + m22
+    rows[..., 1, 1] = 1 + m00 - m11 - m22
+    rows[..., 2, 2] = 1 - m00 + m11 - m22
+    rows[..., 3, 3] = 1 - m00 - m11 + m22
+    rows[..., 0, 1] = rows[..., 1, 0] = m[..., 2, 1] - m[..., 1, 2]
+    rows[..., 0, 2] = rows[..., 2, 0] = m[..., 0, 2] - m[..., 2, 0]
+    rows[..., 0, 3] = rows[..., 3, 0] = m[..., 1, 0] - m[..., 0, 1]
+    rows[..., 1, 2] = rows[..., 2, 1] = m[..., 0, 1] + m[..., 1, 0]
+    rows[..., 1, 3] = rows[..., 3, 1] = m[..., 0, 2] + m[..., 2, 0]
+    rows[..., 2, 3] = rows[..., 3, 2] = m[..., 1, 2] + m[..., 2, 1]
+    
+    largest = np.argmax(np.diagonal(rows, axis1=-2, axis2=-1), axis=-1)
+    q = np.take_along_axis(rows, largest[..., None, None], axis=-2)[..., 0, :]
+    #q and -q are the same rotation, keep w >= 0 so only one shows up
+    q /= np.copysign(np.linalg.norm(q, axis=-1, keepdims=True), q[..., :1])
+    return q
+
+def affineInverse(matrices):
+    #Inverse of (..., 4, 4) affine matrices, the 3x3 part through its adjugate
+    m = matrices[..., :3, :3]
+    adjugate = np.empty(m.shape)
+    for i in range(3):
+        a, b = (i + 1) % 3, (i + 2) % 3
+        #Row i is the cross product of columns a and b
+        adjugate[..., i, 0] = m[..., 1, a] * m[..., 2, b] - m[..., 2, a] * m[..., 1, b]
+        adjugate[..., i, 1] = m[..., 2, a] * m[..., 0, b] - m[..., 0, a] * m[..., 2, b]
+        adjugate[..., i, 2] = m[..., 0, a] * m[..., 1, b] - m[..., 1, a] * m[..., 0, b]
+    determinant = (adjugate[..., 0, :] * m[..., :, 0]).sum(-1)
+    
+    inverse = np.zeros(matrices.shape)
+    inverse[..., :3, :3] = adjugate / determinant[..., None, None]
+    inverse[..., :3, 3] = -(inverse[..., :3, :3] @ matrices[..., :3, 3:])[..., 0]
+    inverse[..., 3, 3] = 1.0
+    return inverse
+
+class PoseExtractor:
+    #Reads every pose bone's matrix_channel with one foreach_get and works out
+    #the parent relative rotations and positions for all of them at once
+    #Built for one armature, matches() is cheap enough for every tick and
+    #layoutMatches() also catches renamed or reparented bones
+    __slots__ = ("key", "layout", "names", "index", "parents", "buffer")
+    
+    def __init__(self, armature):
+        bones = armature.pose.bones
+        self.key = self.armatureKey(armature)
+        self.layout = self.layoutKey(armature)
+        self.names = tuple(b.name for b in bones)
+        self.index = {name:i for i, name in enumerate(self.names)}
+        self.parents = np.array([self.index[b.parent.name] if b.parent else -1 for b in bones], dtype=np.intp)
+        self.buffer = np.empty(len(self.names) * 16, dtype=np.float32)
+    
+    @staticmethod
+    def armatureKey(armature):
+        return (armature.as_pointer(), armature.data.as_pointer(), len(armature.pose.bones))
+    
+    @staticmethod
+    def layoutKey(armature):
+        #Reads every bone's name and parent, only check it when bones may have
+        #been renamed or reparented
+        return hash(tuple((b.name, b.parent.name if b.parent else None) for b in armature.pose.bones))
+    
+    def matches(self, armature):
+        return self.key == self.armatureKey(armature)
+    
+    def layoutMatches(self, armature):
+        return self.matches(armature) and self.layout == self.layoutKey(armature)
+    
+    def channels(self, armature):
+        armature.pose.bones.foreach_get("matrix_channel", self.buffer)
+        #Blender hands matrices over column by column
+        return self.buffer.reshape(-1, 4, 4).transpose(0, 2, 1).astype(np.float64)
+    
+    def extract(self, armature, indices = None):
+        #Rotations as the x, y, z of w >= 0 quaternions and positions, relative
+        #to each bone's parent, for the bones at indices or for all of them
+        channels = self.channels(armature)
+        indices = np.arange(len(self.names)) if indices is None else np.asarray(indices, np.intp)
+        parents = self.parents[indices]
+        
+        local = channels[indices]
+        child = parents >= 0
+        local[child] = affineInverse(channels[parents[child]]) @ local[child]
+        
+        rotations = matricesToQuaternions(local[:, :3, :3])[:, 1:]
+        positions = local[:, :3, 3]
+        return rotations, positions
+
+#Bones to send and what to send for each, indices point into PoseExtractor.names
+TransmitMask = collections.namedtuple("TransmitMask", ("indices", "names", "positions", "rotations"))
+
+def compileTransmitMask(names, transmit):
+    #transmit maps a bone name to its (position, rotation) flags, bones with
+    #neither or missing from it are left out
+    indices = []
+    for i, name in enumerate(names):
+        position, rotation = transmit.get(name, (False, False))
+        if position or rotation:
+            indices.append(i)
+    return TransmitMask(
+        indices = np.array(indices, dtype=np.intp),
+        names = tuple(names[i] for i in indices),
+        positions = tuple(bool(transmit[names[i]][0]) for i in indices),
+        rotations = tuple(bool(transmit[names[i]][1]) for i in indices)
+    )
+
+class PoseDeltaEncoder:
+    #Turns extracted poses into puppetry joint updates, only joints that moved
+    #past their threshold since they were last sent go out, with a full
+    #keyframe every keyframeInterval seconds so the viewer can resync
+    #angle (radians) and distance may be scalars or one value per mask joint
+    __slots__ = ("angle", "distance", "precision", "keyframeInterval",
+        "mask", "rotations", "positions", "lastKeyframe")
+    
+    def __init__(self, angle = 0.0, distance = 0.0, precision = 4, keyframeInterval = 0.5):
+        self.angle = angle
+        self.distance = distance
+        self.precision = precision
+        self.keyframeInterval = keyframeInterval
+        self.reset()
+    
+    def reset(self):
+        self.mask = None
+        self.rotations = None
+        self.positions = None
+        self.lastKeyframe = None
+    
+    def forceKeyframe(self):
+        self.lastKeyframe = None
+    
+    def encode(self, mask, rotations, positions, now):
+        #Returns the "j" updates to send or None when nothing has to go out
+        rotations = np.round(rotations, self.precision)
+        positions = np.round(positions, self.precision)
+        
+        keyframe = mask is not self.mask or self.lastKeyframe is None \
+         or now >= self.lastKeyframe + self.keyframeInterval
+        if keyframe:
+            changed = np.ones(len(mask.names), dtype=bool)
+            self.mask = mask
+            self.rotations = rotations
+            self.positions = positions
+            self.lastKeyframe = now
+        else:
+            #Angle between the sent and current rotation, w is implied by w >= 0
+            w0 = np.sqrt(np.maximum(0, 1 - (self.rotations ** 2).sum(1)))
+            w1 = np.sqrt(np.maximum(0, 1 - (rotations ** 2).sum(1)))
+            dot = np.abs(w0 * w1 + (self.rotations * rotations).sum(1))
+            angle = 2 * np.arccos(np.minimum(dot, 1))
+            distance = np.linalg.norm(positions - self.positions, axis=1)
+            
+            #Values that round the same never count as moved, whatever the noise
+            rotated = (rotations != self.rotations).any(1) & (angle > self.angle)
+            moved = (positions != self.positions).any(1) & (distance > self.distance)
+            changed = (np.asarray(mask.rotations) & rotated) | (np.asarray(mask.positions) & moved)
+            if not changed.any():
+                return None
+            self.rotations[changed] = rotations[changed]
+            self.positions[changed] = positions[changed]
+        
+        updates = {}
+        rotations = rotations.tolist()
+        positions = positions.tolist()
+        for i in np.flatnonzero(changed).tolist():
+            update = {}
+            if mask.rotations[i]:
+                update["r"] = rotations[i]
+            if mask.positions[i]:
+                update["p"] = positions[i]
+            updates[mask.names[i]] = update
+        return updates
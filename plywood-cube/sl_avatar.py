@@ -1,338 +1,177 @@
 #!/usr/bin/env python3
 import os.path
-import struct
 import math
 import bpy
+import numpy as np
+from . import sl_skeleton
+from . import sl_params
+from . import sl_genepool
+from . import sl_skeleton_table
 
-asset_path = os.path.join(os.path.dirname(__file__), "character")
+from .sl_mesh import (
+    asset_path,
+    BINARY_HEADER,
+    LindenMeshError,
+    unpackFile,
+    LindenMeshMorph,
+    LindenMeshLOD,
+    LindenMesh,
+    loadMeshes,
+    jointRenderOrder,
+    unpackWeights
+)
 
-BINARY_HEADER = b"Linden Binary Mesh 1.0\0\0"
+SHARED_KEY = "plywood_shared"
+SHARED_GROUPS_KEY = "plywood_shared_groups"
+MESH_KEY = "plywood_mesh"
 
-sVec2 = struct.Struct("<2f")
-sVec3 = struct.Struct("<3f")
-sUInt16 = struct.Struct("<H")
-sUInt16_3 = struct.Struct("<3H")
-sUInt32 = struct.Struct("<I")
-sUInt32_2 = struct.Struct("<2I")
-sFloat = struct.Struct("<f")
+msgbusOwner = object()
 
-class LindenMeshError(Exception):
-    pass
+def buildMesh(mesh, vertices, faces, texcoords, normals):
+    #Fill the mesh straight from flat buffers instead of from_pydata
+    faces = np.asarray(faces, dtype=np.int32).reshape(-1, 3)
+    loops = faces.ravel()
+    
+    mesh.vertices.add(len(vertices))
+    mesh.loops.add(len(loops))
+    mesh.polygons.add(len(faces))
+    
+    mesh.vertices.foreach_set("co", np.ascontiguousarray(vertices, np.float32).ravel())
+    mesh.loops.foreach_set("vertex_index", loops)
+    mesh.polygons.foreach_set("loop_start", np.arange(0, len(loops), 3, dtype=np.int32))
+    mesh.polygons.foreach_set("loop_total", np.full(len(faces), 3, dtype=np.int32))
+    mesh.polygons.foreach_set("use_smooth", np.ones(len(faces), dtype=bool))
+    mesh.update(calc_edges=True)
+    
+    #UVs are stored per loop, gather them from the per vertex coordinates
+    uv = mesh.uv_layers.new(name='UVMap')
+    uv.data.foreach_set("uv", np.ascontiguousarray(texcoords, np.float32)[loops].ravel())
+    
+    mesh.use_auto_smooth = True
+    mesh.normals_split_custom_set_from_vertices(np.ascontiguousarray(normals, np.float32))
+    return mesh
 
-def unpackFile(handle, lod = 0):
-    header = handle.read(len(BINARY_HEADER))
-    if header != BINARY_HEADER:
-        raise LindenMeshError("Invalid Mesh Header!")
-    
-    readWeights = handle.read(1)[0] == 1 and not lod
-    readDetailUVs = handle.read(1)[0] == 1
-    
-    position = sVec3.unpack(handle.read(sVec3.size))
-    
-    rotation = (*sVec3.unpack(handle.read(sVec3.size)), handle.read(1)[0])
-    
-    scale = sVec3.unpack(handle.read(sVec3.size))
-    
-    vertices = None
-    normals = None
-    binormals = None
-    texcoords = None
-    detailTexcoords = None
-    weights = None
-    
-    if not lod:
-        vCount, = sUInt16.unpack(handle.read(sUInt16.size))
-        vertices = [None] * vCount
-        for i in range(0, vCount):
-            vertices[i] = sVec3.unpack(handle.read(sVec3.size))
-        
-        normals = [None] * vCount
-        for i in range(0, vCount):
-            normals[i] = sVec3.unpack(handle.read(sVec3.size))
-        
-        binormals = [None] * vCount
-        for i in range(0, vCount):
-            binormals[i] = sVec3.unpack(handle.read(sVec3.size))
-        
-        texcoords = [None] * vCount
-        for i in range(0, vCount):
-            texcoords[i] = sVec2.unpack(handle.read(sVec2.size))
-        
-        if readDetailUVs:
-            detailTexcoords = [None] * vCount
-            for i in range(0, vCount):
-                detailTexcoords[i] = sVec2.unpack(handle.read(sVec2.size))
-        
-        if readWeights:
-            weights = [None] * vCount
-            for i in range(0, vCount):
-                weights[i], = sFloat.unpack(handle.read(sFloat.size))
-    
-    
-    fCount, = sUInt16.unpack(handle.read(sUInt16.size))
-    faces = [None] * fCount
-    maxIndice = 0
-    for i in range(fCount):
-        faces[i] = sUInt16_3.unpack(handle.read(sUInt16_3.size))
-        
-        if lod:
-            maxIndice = max(maxIndice, max(faces[i]))
-    
-    joints = None
-    morphs = None
-    remaps = None
-    if not lod:
-        if readWeights:
-            jCount, = sUInt16.unpack(handle.read(sUInt16.size))
-            joints = [None] * jCount
-            for i in range(jCount):
-                joints[i] = handle.read(64).split(b"\0")[0].decode()
-        
-        morphs = {}
-        while True:
-            morphName = handle.read(64)
-            if len(morphName) != 64:
-                break
-            
-            morphName = morphName.split(b"\0")[0].decode()
-            if morphName == "End Morphs":
-                break
-            
-            mCount, = sUInt32.unpack(handle.read(sUInt32.size))
-            
-            morphIndices = [None] * mCount
-            morphVertices = [None] * mCount
-            morphNormals = [None] * mCount
-            morphBinormals = [None] * mCount
-            morphTexcoords = [None] * mCount
-            
-            for i in range(mCount):
-                morphIndices[i], = sUInt32.unpack(handle.read(sUInt32.size))
-                morphVertices[i] = sVec3.unpack(handle.read(sVec3.size))
-                morphNormals[i] = sVec3.unpack(handle.read(sVec3.size))
-                morphBinormals[i] = sVec3.unpack(handle.read(sVec3.size))
-                morphTexcoords[i] = sVec2.unpack(handle.read(sVec2.size))
-            
-            morphs[morphName] = {
-                "vertices": morphVertices,
-                "normals": morphNormals,
-                "binormals": morphBinormals,
-                "texcoords": morphTexcoords,
-                "indices": morphIndices
-            }
-        
-        rCount, = sUInt32.unpack(handle.read(sUInt32.size))
-        remaps = {}
-        for i in range(rCount):
-            a, b = sUInt32_2.unpack(handle.read(sUInt32_2.size))
-            remaps[a] = b
-    
-    return {
-        "lod": lod,
-        "position": position,
-        "rotation": rotation,
-        "scale": scale,
-        "vertices": vertices,
-        "normals": normals,
-        "binormals": binormals,
-        "texcoords": texcoords,
-        "detailTexcoords": detailTexcoords,
-        "weights": weights,
-        "faces": faces,
-        "joints": joints,
-        "morphs": morphs,
-        "remaps": remaps
-    }
-
-class LindenMeshMorph:
-    def __init__(self, parent):
-        self.parent = parent
-        self.indices = []
-        self.vertices = []
-        self.normals = []
-        self.binormals = []
-        self.texcoords = []
-    
-    @classmethod
-    def load(cls, data, parent):
-        self = cls(parent)
-        self.indices = data["indices"]
-        self.vertices = data["vertices"]
-        self.normals = data["normals"]
-        self.binormals = data["binormals"]
-        self.texcoords = data["texcoords"]
-        return self
-
-class LindenMeshLOD:
-    def __init__(self, parent):
-        self.parent = parent
-        self.lod = 0
-        self.position = (0,0,0)
-        self.rotation = (0,0,0,0)
-        self.scale = (0,0,0)
-        self.faces = []
-        self._vertices = []
-        self._normals = []
-        self._binormals = []
-        self._texcoords = []
-        self._detailTexcoords = []
-        self._joints = []
-        self._morphs = []
-        self._remaps = []
-
-    @classmethod
-    def load(cls, data, parent):
-        self = cls(parent)
-        self.lod = data["lod"]
-        self.position = data["position"]
-        self.rotation = data["rotation"]
-        self.scale = data["scale"]
-        self.faces = data["faces"]
-        
-        #Proxied
-        self._vertices = data["vertices"]
-        self._normals = data["normals"]
-        self._binormals = data["binormals"]
-        self._texcoords = data["texcoords"]
-        self._detailTexcoords = data["detailTexcoords"]
-        self._weights = data["weights"]
-        self._joints = data["joints"]
-        self._morphs = {k:LindenMeshMorph.load(v, self) for k,v in data["morphs"].items()}
-        self._remaps = data["remaps"]
-        
-        return self
-    
-    @property
-    def vertices(self):
-        if self._vertices:
-            return self._vertices
-        return self.parent.lods[0]._vertices
-    
-    @property
-    def normals(self):
-        if self._normals:
-            return self._normals
-        return self.parent.lods[0]._normals
-    
-    @property
-    def binormals(self):
-        if self._binormals:
-            return self._binormals
-        return self.parent.lods[0]._binormals
-    
-    @property
-    def texcoords(self):
-        if self._texcoords:
-            return self._texcoords
-        return self.parent.lods[0]._texcoords
-    
-    @property
-    def detailTexcoords(self):
-        if self._detailTexcoords:
-            return self._detailTexcoords
-        return self.parent.lods[0]._detailTexcoords
-    
-    @property
-    def weights(self):
-        if self._weights:
-            return self._weights
-        return self.parent.lods[0]._weights
-    
-    @property
-    def joints(self):
-        if self._joints:
-            return self._joints
-        return self.parent.lods[0]._joints
-    
-    @property
-    def morphs(self):
-        if self._morphs:
-            return self._morphs
-        return self.parent.lods[0]._morphs
-    
-    @property
-    def remaps(self):
-        if self._remaps:
-            return self._remaps
-        return self.parent.lods[0]._remaps
-    
-
-class LindenMesh:
-    def __init__(self, name):
-        self.name = name
-        self.lods = []
-    
-    @classmethod
-    def load(cls, path, loadLODs = False):
-        self = cls(os.path.split(path)[-1])
-        
-        with open(path+".llm", "rb") as f:
-            self.lods.append(LindenMeshLOD.load(unpackFile(f), self))
-        
-        if loadLODs:
-            #Load all the LODs
-            i = 1
-            while True:
-                try:
-                    with open(path+"_{}.llm".format(i), "rb") as f:
-                        self.lods.append(LindenMeshLOD.load(unpackFile(f, i), self))
-                    i += 1
-                except FileNotFoundError:
-                    break
-        
-        return self
+def skinningBones():
+    #The stock meshes are weighted against the skeleton without the extended
+    #(Bento) bones, so those are skipped when working out each joint's parent
+    skeleton = sl_skeleton_table.loadSkeleton()
+    result = []
+    for bone in skeleton:
+        if bone.type != "bone" or bone.support != "base":
+            continue
+        parent = bone.parent
+        while parent >= 0 and skeleton[parent].support != "base":
+            parent = skeleton[parent].parent
+        result.append((bone.name, skeleton[parent].name if parent >= 0 else None))
+    return result
 
 #BEGIN TEST CODE
-def addLindenMesh(lm, lod = 0):
+def addLindenMesh(lm, lod = 0, morphs = None):
     #Create the base data
     mesh = bpy.data.meshes.new(lm.name)
     obj = bpy.data.objects.new(mesh.name, mesh)
     col = bpy.data.collections["Collection"]
     col.objects.link(obj)
-    #Import the vertices and faces
-    mesh.from_pydata(lm.lods[lod].vertices, [], lm.lods[lod].faces)
-    mesh.polygons.foreach_set("use_smooth", [True]*len(lm.lods[lod].faces))
-    
-    #Import UVs
-    uv = obj.data.uv_layers.new(name='UVMap')
-    for loop in obj.data.loops:
-        uv.data[loop.index].uv = lm.lods[lod].texcoords[loop.vertex_index]
-    
-    #Import normal
-    obj.data.use_auto_smooth = True
-    obj.data.normals_split_custom_set_from_vertices( lm.lods[lod].normals )
+    #Import the vertices, faces, UVs and normals
+    buildMesh(mesh,
+        lm.lods[lod].vertices,
+        lm.lods[lod].faces,
+        lm.lods[lod].texcoords,
+        lm.lods[lod].normals
+    )
     
     #Add vertex groups
-    if lm.lods[lod].weights:
-        weights = [None] * len(lm.lods[lod].weights)
-        for i in range(len(lm.lods[lod].weights)):
-            joint = math.floor(lm.lods[lod].weights[i]) - 1
-            value = lm.lods[lod].weights[i] - math.floor(joint)
-            weights[i] = (joint, value)
+    if lm.lods[lod].weights is not None:
+        for joint in lm.lods[lod].joints:
+            obj.vertex_groups.new(name=joint)
         
-        for jointIndex, joint in enumerate(lm.lods[lod].joints):
-            vg = obj.vertex_groups.new(name=joint)
-            for vert in range(len(weights)):
-                if weights[vert][0] == jointIndex:
-                    vg.add([vert], weights[vert][1], "ADD")
-    
-    #Add morphs
+        order = jointRenderOrder(lm.lods[lod].joints, skinningBones())
+        vertices, joints, values = unpackWeights(lm.lods[lod].weights, len(order))
+        
+        #One call for each run of vertices sharing a joint and weight
+        sort = np.lexsort((values, joints))
+        vertices, joints, values = vertices[sort], joints[sort], values[sort]
+        starts = np.flatnonzero((np.diff(joints) != 0) | (np.diff(values) != 0)) + 1
+        for chunk in np.split(np.arange(len(vertices)), starts):
+            name = order[joints[chunk[0]]] if len(chunk) else None
+            if name is None:
+                continue
+            vg = obj.vertex_groups.get(name) or obj.vertex_groups.new(name=name)
+            vg.add(vertices[chunk].tolist(), float(values[chunk[0]]), "ADD")
+    
+    #Add morphs, all of them unless only some are asked for
     if lm.lods[lod].morphs:
+        if morphs is None:
+            morphs = lm.lods[lod].morphs.keys()
+        
         sk = obj.shape_key_add(name="Basis", from_mix=True)
         sk.interpolation = 'KEY_LINEAR'
-        for morph in lm.lods[lod].morphs:
+        base = np.ascontiguousarray(lm.lods[lod].vertices, np.float32)
+        for morph in morphs:
             sk = obj.shape_key_add(name=morph, from_mix=False)
             sk.interpolation = 'KEY_LINEAR'
-            for i in range(len(lm.lods[lod].morphs[morph].indices)):
-                dest = lm.lods[lod].morphs[morph].indices[i]
-                sk.data[dest].co = (
-                    lm.lods[lod].morphs[morph].vertices[i][0] + lm.lods[lod].vertices[dest][0],
-                    lm.lods[lod].morphs[morph].vertices[i][1] + lm.lods[lod].vertices[dest][1],
-                    lm.lods[lod].morphs[morph].vertices[i][2] + lm.lods[lod].vertices[dest][2]
-                )
+            co = base.copy()
+            np.add.at(co, lm.lods[lod].morphs[morph].indices, lm.lods[lod].morphs[morph].vertices)
+            sk.data.foreach_set("co", co.ravel())
     return obj
 
-def attachMeshesToArmature(armature, meshes=None):
+def addSharedLindenMesh(lm, lod = 0):
+    #Every object made from the same stock mesh links to one mesh datablock,
+    #the object gets its own copy once it is edited (see unshareEditedMesh)
+    key = "{}:{}".format(lm.name, lod)
+    for mesh in bpy.data.meshes:
+        if mesh.get(SHARED_KEY) == key:
+            break
+    else:
+        obj = addLindenMesh(lm, lod)
+        obj.data[SHARED_KEY] = key
+        obj.data[SHARED_GROUPS_KEY] = "\n".join(vg.name for vg in obj.vertex_groups)
+        return obj
+    
+    #Vertex group names live on the object, the weights on the mesh
+    obj = bpy.data.objects.new(mesh.name, mesh)
+    col = bpy.data.collections["Collection"]
+    col.objects.link(obj)
+    for name in filter(None, mesh[SHARED_GROUPS_KEY].split("\n")):
+        obj.vertex_groups.new(name=name)
+    return obj
+
+def unshareEditedMesh():
+    obj = bpy.context.active_object
+    if obj is None or obj.type != "MESH" or obj.mode == "OBJECT":
+        return None
+    
+    mesh = obj.data
+    if mesh.users < 2 or SHARED_KEY not in mesh:
+        return None
+    
+    mode = obj.mode
+    bpy.ops.object.mode_set(mode="OBJECT")
+    unshareMesh(obj)
+    bpy.ops.object.mode_set(mode=mode)
+    return None
+
+def unshareMesh(obj):
+    #Gives obj its own copy of a shared mesh, in object mode
+    obj.data = obj.data.copy()
+    del obj.data[SHARED_KEY]
+    del obj.data[SHARED_GROUPS_KEY]
+
+def subscribeModeChanges():
+    #Mode changes are how edits start, unshare from a timer outside the notifier
+    bpy.msgbus.subscribe_rna(
+        key=(bpy.types.Object, "mode"),
+        owner=msgbusOwner,
+        args=(),
+        notify=lambda *args: bpy.app.timers.register(unshareEditedMesh)
+    )
+
+@bpy.app.handlers.persistent
+def resubscribeModeChanges(dummy):
+    #Subscriptions are dropped when a file is loaded
+    subscribeModeChanges()
+
+def attachMeshesToArmature(armature, meshes=None, shared=False):
     #List of meshes to import
     if not meshes:
         meshes = [
@@ -348,10 +187,13 @@ def attachMeshesToArmature(armature, meshes=None):
     
     eyed = 0 #Eye-D tracker, get it, ID, EyeD....
     
+    #Files are read and decoded in parallel, only the datablocks are made here
+    loaded = loadMeshes([os.path.join(asset_path, mesh) for mesh in meshes])
+    
     added = []
-    for mesh in meshes:
-        lm = LindenMesh.load(os.path.join(asset_path, mesh))
-        obj = addLindenMesh(lm)
+    for mesh, lm in zip(meshes, loaded):
+        obj = addSharedLindenMesh(lm) if shared else addLindenMesh(lm)
+        obj[MESH_KEY] = mesh
         added.append(obj)
         
         #Don't parent anything if we don't have a armature selected
@@ -389,11 +231,56 @@ def attachMeshesToArmature(armature, meshes=None):
                 arm.object = armature
     return added
 
+def applyParamState(armature, state):
+    #Pushes only the outputs that changed since the last call to the rig
+    applyParamOutputs(armature, state.flush(), state.graph.meshFiles)
+
+def applyParamOutputs(armature, outputs, meshFiles):
+    #outputs maps an owner to its evaluated output, see sl_params.VisualParamState,
+    #shape key values live on the mesh so shared meshes are unshared first
+    meshes = {}
+    for obj in armature.children:
+        if MESH_KEY in obj:
+            meshes.setdefault(obj[MESH_KEY], []).append(obj)
+    
+    for owner, output in outputs.items():
+        if owner[0] == "skeleton":
+            sl_skeleton.apply_shape(armature, *output)
+        elif owner[0] == "mesh":
+            for obj in meshes.get(meshFiles.get(owner[1]), ()):
+                keys = obj.data.shape_keys
+                if keys is None:
+                    continue
+                if SHARED_KEY in obj.data and obj.data.users > 1:
+                    unshareMesh(obj)
+                    keys = obj.data.shape_keys
+                for name, weight in output.items():
+                    key = keys.key_blocks.get(name)
+                    if key is not None:
+                        key.slider_min = min(key.slider_min, weight)
+                        key.slider_max = max(key.slider_max, weight)
+                        key.value = weight
+
+def addAvatars(context, valueSets, spacing = 1.0, location = (0,0,0), workers = None):
+    #The param evaluation for every avatar runs in a pool first, the stock
+    #meshes are decoded once through the mesh pool and the rigs are template copies
+    #Every avatar gets its own meshes since the morph weights differ
+    results = sl_genepool.generateAvatars(valueSets, workers)
+    meshFiles = sl_params.loadParamGraph().meshFiles
+    rigs = sl_skeleton.add_skeletons(context, len(results), spacing, location, shapeable=True)
+    for rig, result in zip(rigs, results):
+        attachMeshesToArmature(rig)
+        applyParamOutputs(rig, result["outputs"], meshFiles)
+    return rigs
+
 def register():
-    pass
+    subscribeModeChanges()
+    bpy.app.handlers.load_post.append(resubscribeModeChanges)
 
 def unregister():
-    pass
+    bpy.msgbus.clear_by_owner(msgbusOwner)
+    if resubscribeModeChanges in bpy.app.handlers.load_post:
+        bpy.app.handlers.load_post.remove(resubscribeModeChanges)
 
 if __name__ == "__main__":
     #List of meshes to import
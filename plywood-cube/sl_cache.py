@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+import os
+import threading
+
+def cachePath(name):
+    #Per user cache directory, under XDG_CACHE_HOME when it is set
+    return os.path.join(
+        os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")),
+        "plywood-cube", name
+    )
+
+def fileStamp(path):
+    #Changes whenever the file is rewritten
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime_ns)
+
+class Memo:
+    #Values built once per key and shared, built again when the stamp they
+    #were built for changes, a fileStamp or the object they were built from
+    __slots__ = ("entries", "lock")
+    
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+    
+    def get(self, key, stamp, build):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != stamp:
+                entry = (stamp, build())
+                self.entries[key] = entry
+            return entry[1]
+    
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
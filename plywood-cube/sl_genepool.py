@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+import os
+import random
+import concurrent.futures
+import xml.etree.ElementTree as ET
+from . import sl_params
+from . import sl_cache
+
+genepool_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "character", "genepool.xml")
+
+class GenepoolError(Exception):
+    pass
+
+def parseGenepool(path = genepool_path):
+    #Archetype name to its param values by id, names are stripped since some
+    #of the stock ones carry a leading space
+    archetypes = {}
+    for archetype in ET.parse(path).getroot().iter("archetype"):
+        archetypes[archetype.attrib["name"].strip()] = {
+            int(p.attrib["id"]):float(p.attrib["value"]) for p in archetype.iter("param")
+        }
+    return archetypes
+
+loaded = sl_cache.Memo()
+
+def loadGenepool(path = genepool_path):
+    return loaded.get(path, sl_cache.fileStamp(path), lambda: parseGenepool(path))
+
+def archetypeValues(names):
+    genepool = loadGenepool()
+    try:
+        return [dict(genepool[name.strip()]) for name in names]
+    except KeyError as e:
+        raise GenepoolError("Unknown archetype {}".format(e)) from None
+
+def randomBlends(count, archetypes = None, parents = 2, seed = None):
+    #Random convex mixes of a few archetypes each, params an archetype leaves
+    #out count with their default
+    genepool = loadGenepool()
+    graph = sl_params.loadParamGraph()
+    names = [name.strip() for name in archetypes] if archetypes else list(genepool.keys())
+    unknown = [name for name in names if name not in genepool]
+    if unknown:
+        raise GenepoolError("Unknown archetypes {}".format(unknown))
+    rng = random.Random(seed)
+    
+    result = []
+    for i in range(count):
+        chosen = rng.sample(names, min(parents, len(names)))
+        weights = [rng.random() + 1e-6 for name in chosen]
+        total = sum(weights)
+        ids = set().union(*(genepool[name] for name in chosen))
+        values = {}
+        for id in ids:
+            default = graph.params[id].default if id in graph.params else 0.0
+            values[id] = sum(w * genepool[name].get(id, default) for w, name in zip(weights, chosen)) / total
+        result.append(values)
+    return result
+
+def evaluateAvatar(values):
+    #Everything about an avatar that does not need Blender, safe to run in a
+    #worker thread or process
+    graph = sl_params.loadParamGraph()
+    state = sl_params.VisualParamState(graph, {id:v for id, v in values.items() if id in graph.params})
+    return {
+        "values": dict(state.values),
+        "male": state.male,
+        "outputs": state.flush()
+    }
+
+def generateAvatars(valueSets, workers = None, executor = None):
+    #Evaluates every value set in a pool, the parsed skeleton, params and
+    #shape coefficients are loaded once up front and shared by the workers
+    sl_params.loadParamGraph()
+    sl_params.sl_shape.loadShapeEngine()
+    if executor is not None:
+        return list(executor.map(evaluateAvatar, valueSets))
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        return list(pool.map(evaluateAvatar, valueSets))
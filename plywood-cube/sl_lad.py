@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+import os
+import json
+import struct
+import hashlib
+import threading
+import xml.etree.ElementTree as ET
+try:
+    from . import sl_cache
+except ImportError:
+    #Run on its own, outside the add-on
+    import sl_cache
+
+lad_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "character", "avatar_lad.xml")
+
+CACHE_VERSION = 1
+CACHE_HEADER = b"Plywood Cube LAD Cache 1.0\0"
+
+sUInt32 = struct.Struct("<I")
+
+cache_path = sl_cache.cachePath("lad")
+
+class LindenAvatarError(Exception):
+    pass
+
+def parseLAD(path = lad_path):
+    #Streams the file once into plain lists and dicts
+    #A param is {"id", "attrib", "kind", "data", "owner", "body"} where kind is
+    #the param_* tag, data its attributes, owner where the param was found
+    #(["mesh", type], ["layer_set", region, layer], ["global_color", name],
+    #["skeleton"] or ["driver"]) and body the [tag, attrib] pairs inside it
+    result = {
+        "version": CACHE_VERSION,
+        "attrib": {},
+        "skeleton": {},
+        "params": [],
+        "meshes": [],
+        "layerSets": [],
+        "globalColors": [],
+        "attachmentPoints": [],
+        "morphMasks": []
+    }
+    
+    stack = []
+    param = None
+    owner = None
+    try:
+        for event, element in ET.iterparse(path, events=("start", "end")):
+            tag = element.tag
+            if event == "end":
+                stack.pop()
+                if tag == "param":
+                    result["params"].append(param)
+                    param = None
+                if len(stack) == 1:
+                    #Top level element done, drop it so the tree never builds up
+                    stack[0].clear()
+                continue
+            
+            depth = len(stack)
+            stack.append(element)
+            attrib = dict(element.attrib)
+            if depth == 0:
+                result["attrib"] = attrib
+            
+            elif param is not None:
+                if tag.startswith("param_") and param["kind"] is None:
+                    param["kind"] = tag
+                    param["data"] = attrib
+                else:
+                    param["body"].append([tag, attrib])
+            
+            elif tag == "param":
+                param = {
+                    "id": int(attrib["id"]),
+                    "attrib": attrib,
+                    "kind": None,
+                    "data": {},
+                    "owner": owner,
+                    "body": []
+                }
+            
+            elif depth == 1:
+                if tag == "mesh":
+                    result["meshes"].append(attrib)
+                    owner = ["mesh", attrib["type"]]
+                elif tag == "layer_set":
+                    result["layerSets"].append({"attrib": attrib, "layers": []})
+                    owner = ["layer_set", attrib["body_region"], None]
+                elif tag == "global_color":
+                    result["globalColors"].append(attrib)
+                    owner = ["global_color", attrib["name"]]
+                elif tag == "skeleton":
+                    result["skeleton"] = attrib
+                    owner = ["skeleton"]
+                elif tag == "driver_parameters":
+                    owner = ["driver"]
+                else:
+                    owner = None
+            
+            elif tag == "attachment_point":
+                result["attachmentPoints"].append(attrib)
+            elif tag == "mask":
+                result["morphMasks"].append(attrib)
+            elif tag == "layer":
+                result["layerSets"][-1]["layers"].append(attrib)
+                owner = ["layer_set", owner[1], attrib.get("name")]
+    except ET.ParseError as e:
+        raise LindenAvatarError("Could not parse {}: {}".format(path, e)) from None
+    
+    return result
+
+class LindenAvatarDefinition:
+    #Indexed view of a parsed avatar_lad.xml
+    #byId holds every definition of a param, the same id can appear in several
+    #layers, byName the ids sharing a name
+    __slots__ = ("data", "params", "byId", "byName", "meshes", "layerSets",
+        "globalColors", "attachmentPoints", "attachmentsByName", "morphMasks", "skeleton")
+    
+    def __init__(self, data):
+        if data.get("version") != CACHE_VERSION:
+            raise LindenAvatarError("Unsupported definition version {}".format(data.get("version")))
+        self.data = data
+        self.params = data["params"]
+        self.skeleton = data["skeleton"]
+        self.morphMasks = data["morphMasks"]
+        
+        self.byId = {}
+        self.byName = {}
+        for param in self.params:
+            self.byId.setdefault(param["id"], []).append(param)
+            ids = self.byName.setdefault(param["attrib"]["name"], [])
+            if param["id"] not in ids:
+                ids.append(param["id"])
+        
+        #Mesh type to its LODs in order, layer_set body region to its layers
+        self.meshes = {}
+        for mesh in data["meshes"]:
+            self.meshes.setdefault(mesh["type"], []).append(mesh)
+        for lods in self.meshes.values():
+            lods.sort(key=lambda m: int(m.get("lod", 0)))
+        self.layerSets = {s["attrib"]["body_region"]:s for s in data["layerSets"]}
+        self.globalColors = {c["name"]:c for c in data["globalColors"]}
+        self.attachmentPoints = {int(a["id"]):a for a in data["attachmentPoints"]}
+        self.attachmentsByName = {a["name"]:a for a in data["attachmentPoints"]}
+    
+    def param(self, key):
+        #All definitions of a param by id or name
+        if isinstance(key, str):
+            return [p for id in self.byName.get(key, ()) for p in self.byId[id]]
+        return self.byId.get(key, [])
+    
+    def paramsFor(self, *owner):
+        #Params found under an owner, a prefix like ("layer_set", "head") matches
+        #every layer of that layer set
+        return [p for p in self.params if p["owner"] and p["owner"][:len(owner)] == list(owner)]
+    
+    def attachmentPoint(self, key):
+        if isinstance(key, str):
+            return self.attachmentsByName.get(key)
+        return self.attachmentPoints.get(key)
+
+def fileDigest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def packCache(data):
+    #Same layout as the mesh cache, a JSON header, with no arrays after it
+    header = json.dumps(data, separators=(",", ":")).encode()
+    return CACHE_HEADER + sUInt32.pack(len(header)) + header
+
+def unpackCache(buffer):
+    if buffer[:len(CACHE_HEADER)] != CACHE_HEADER:
+        raise LindenAvatarError("Invalid Cache Header!")
+    
+    offset = len(CACHE_HEADER) + sUInt32.size
+    length, = sUInt32.unpack_from(buffer, len(CACHE_HEADER))
+    if offset + length > len(buffer):
+        raise LindenAvatarError("Unexpected end of file!")
+    data = json.loads(buffer[offset:offset + length])
+    if not isinstance(data, dict) or data.get("version") != CACHE_VERSION:
+        raise LindenAvatarError("Unsupported cache version!")
+    return data
+
+def loadCached(path, cache):
+    digest = fileDigest(path)
+    entry = os.path.join(cache, digest + ".cache")
+    try:
+        with open(entry, "rb") as f:
+            return unpackCache(f.read())
+    except Exception:
+        #The cache is only there to skip the parse, anything wrong with it
+        #means parsing again
+        pass
+    
+    data = parseLAD(path)
+    try:
+        os.makedirs(cache, exist_ok=True)
+        temp = "{}.{}.{}.tmp".format(entry, os.getpid(), threading.get_ident())
+        with open(temp, "wb") as f:
+            f.write(packCache(data))
+        os.replace(temp, entry)
+    except OSError:
+        pass
+    return data
+
+loaded = sl_cache.Memo()
+
+def loadLAD(path = lad_path, cache = cache_path):
+    #Parsed once per process and only reparsed when the file changes,
+    #the parsed form is also kept on disk keyed by the file's hash
+    return loaded.get(path, sl_cache.fileStamp(path), lambda: LindenAvatarDefinition(
+        loadCached(path, cache) if cache else parseLAD(path)))
+
+if __name__ == "__main__":
+    import time
+    import tempfile
+    
+    with tempfile.TemporaryDirectory() as cache:
+        start = time.perf_counter()
+        ET.parse(lad_path)
+        print("ElementTree parse: {:.1f}ms".format((time.perf_counter() - start) * 1000))
+        
+        start = time.perf_counter()
+        data = loadCached(lad_path, cache)
+        print("iterparse and cache: {:.1f}ms".format((time.perf_counter() - start) * 1000))
+        
+        start = time.perf_counter()
+        lad = LindenAvatarDefinition(loadCached(lad_path, cache))
+        print("Cached load: {:.1f}ms".format((time.perf_counter() - start) * 1000))
+        
+        print("{} params, {} meshes, {} layer sets, {} attachment points".format(
+            len(lad.byId), len(lad.meshes), len(lad.layerSets), len(lad.attachmentPoints)))
@@ -0,0 +1,1032 @@
+#!/usr/bin/env python3
+import os
+import os.path
+import io
+import mmap
+import json
+import math
+import struct
+import hashlib
+import threading
+import collections
+import concurrent.futures
+import numpy as np
+try:
+    from . import sl_cache
+except ImportError:
+    #Run on its own, outside the add-on
+    import sl_cache
+
+asset_path = os.path.join(os.path.dirname(__file__), "character")
+
+BINARY_HEADER = b"Linden Binary Mesh 1.0\0\0"
+
+sHeader = struct.Struct("<{}sBB3f3fB3f".format(len(BINARY_HEADER)))
+sUInt16 = struct.Struct("<H")
+sUInt32 = struct.Struct("<I")
+
+dVec2 = np.dtype(("<f4", 2))
+dVec3 = np.dtype(("<f4", 3))
+dFloat = np.dtype("<f4")
+dFace = np.dtype(("<u2", 3))
+dRemap = np.dtype(("<u4", 2))
+dMorphVertex = np.dtype([
+    ("indices", "<u4"),
+    ("vertices", "<f4", 3),
+    ("normals", "<f4", 3),
+    ("binormals", "<f4", 3),
+    ("texcoords", "<f4", 2)
+])
+
+NAME_LENGTH = 64
+
+CACHE_HEADER = b"Plywood Cube Mesh Cache 1.0\0"
+CACHE_ALIGNMENT = 16
+
+cache_path = sl_cache.cachePath("meshes")
+
+class LindenMeshError(Exception):
+    pass
+
+def readSection(handle, size):
+    #Read a whole section in one go so it can be decoded in bulk
+    data = handle.read(size)
+    if len(data) != size:
+        raise LindenMeshError("Unexpected end of file!")
+    return data
+
+def skipSection(handle, size):
+    #Only used on mapped files, returns the offset of the skipped section
+    offset = handle.tell()
+    if offset + size > len(handle):
+        raise LindenMeshError("Unexpected end of file!")
+    handle.seek(size, os.SEEK_CUR)
+    return offset
+
+def unpackArray(handle, dtype, count):
+    if isinstance(handle, mmap.mmap):
+        #Zero-copy view into the mapping
+        offset = skipSection(handle, dtype.itemsize * count)
+        return np.frombuffer(handle, dtype, count, offset)
+    return np.frombuffer(readSection(handle, dtype.itemsize * count), dtype)
+
+MORPH_COLUMNS = ("indices", "vertices", "normals", "binormals", "texcoords")
+
+def unpackMorph(records):
+    #Morph vertices are interleaved, these are strided views of each column
+    return {k:records[k] for k in MORPH_COLUMNS}
+
+def jointRenderOrder(joints, bones):
+    #Weights index the joints in the order the viewer uploads their matrices,
+    #a depth first walk of the skeleton where each run of skinned joints is
+    #preceded by its parent. bones is (name, parent) in depth first order
+    skinned = set(joints)
+    order = []
+    for name, parent in bones:
+        if name not in skinned:
+            continue
+        if not order or order[-1] != parent:
+            order.append(parent)
+        order.append(name)
+    return order
+
+def unpackWeights(weights, jointCount):
+    #The integer part indexes the joint render order, the fraction is how
+    #much of the vertex is blended into the joint after it
+    #Returns flat vertex, joint and weight arrays, one entry per influence
+    weights = np.asarray(weights, np.float32)
+    base = np.floor(weights)
+    joints = base.astype(np.int32)
+    fractions = weights - base
+    vertices = np.arange(len(weights), dtype=np.int32)
+    
+    valid = (joints >= 0) & (joints < jointCount)
+    blended = valid & (fractions > 0) & (joints + 1 < jointCount)
+    
+    #Without a next joint the vertex stays fully on its own joint
+    values = np.where(blended, 1 - fractions, 1).astype(np.float32)
+    
+    return (
+        np.concatenate((vertices[valid], vertices[blended])),
+        np.concatenate((joints[valid], joints[blended] + 1)),
+        np.concatenate((values[valid], fractions[blended]))
+    )
+
+def lodFromPath(path):
+    #avatar_head.llm is LOD 0, avatar_head_1.llm is LOD 1 and so on
+    lod = os.path.basename(path)[:-4].rsplit("_", 1)[-1]
+    return int(lod) if lod.isdigit() else 0
+
+def mapFile(handle):
+    return mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+def unpackName(data):
+    return data.split(b"\0")[0].decode()
+
+def unpackEmptyTail(handle, hasWeights):
+    #LOD files end with empty joint, morph and remap sections, anything else
+    #means the file is not the LOD it was read as
+    try:
+        if hasWeights and sUInt16.unpack(readSection(handle, sUInt16.size))[0]:
+            return False
+        if unpackName(readSection(handle, NAME_LENGTH)) != "End Morphs":
+            return False
+        return sUInt32.unpack(readSection(handle, sUInt32.size))[0] == 0
+    except (LindenMeshError, UnicodeDecodeError):
+        return False
+
+def unpackFile(handle, lod = 0):
+    header, hasWeights, hasDetailUVs, \
+     px, py, pz, rx, ry, rz, rOrder, sx, sy, sz \
+     = sHeader.unpack(readSection(handle, sHeader.size))
+    
+    if header != BINARY_HEADER:
+        raise LindenMeshError("Invalid Mesh Header!")
+    
+    readWeights = hasWeights == 1 and not lod
+    readDetailUVs = hasDetailUVs == 1
+    
+    position = (px, py, pz)
+    rotation = (rx, ry, rz, rOrder)
+    scale = (sx, sy, sz)
+    
+    vertices = None
+    normals = None
+    binormals = None
+    texcoords = None
+    detailTexcoords = None
+    weights = None
+    
+    if not lod:
+        vCount, = sUInt16.unpack(readSection(handle, sUInt16.size))
+        vertices = unpackArray(handle, dVec3, vCount)
+        normals = unpackArray(handle, dVec3, vCount)
+        binormals = unpackArray(handle, dVec3, vCount)
+        texcoords = unpackArray(handle, dVec2, vCount)
+        
+        if readDetailUVs:
+            detailTexcoords = unpackArray(handle, dVec2, vCount)
+        
+        if readWeights:
+            weights = unpackArray(handle, dFloat, vCount)
+    
+    fCount, = sUInt16.unpack(readSection(handle, sUInt16.size))
+    faces = unpackArray(handle, dFace, fCount)
+    
+    joints = None
+    morphs = None
+    remaps = None
+    if not lod:
+        if readWeights:
+            jCount, = sUInt16.unpack(readSection(handle, sUInt16.size))
+            data = readSection(handle, NAME_LENGTH * jCount)
+            joints = [unpackName(data[i:i + NAME_LENGTH])
+                for i in range(0, len(data), NAME_LENGTH)]
+        
+        morphs = {}
+        while True:
+            morphName = handle.read(NAME_LENGTH)
+            if len(morphName) != NAME_LENGTH:
+                break
+            
+            morphName = unpackName(morphName)
+            if morphName == "End Morphs":
+                break
+            
+            mCount, = sUInt32.unpack(readSection(handle, sUInt32.size))
+            
+            if isinstance(handle, mmap.mmap):
+                #Only index the morph, it is decoded on first access
+                morphs[morphName] = {
+                    "buffer": handle,
+                    "offset": skipSection(handle, dMorphVertex.itemsize * mCount),
+                    "count": mCount
+                }
+                continue
+            
+            records = unpackArray(handle, dMorphVertex, mCount)
+            morphs[morphName] = {k:np.ascontiguousarray(v)
+                for k,v in unpackMorph(records).items()}
+        
+        rCount, = sUInt32.unpack(readSection(handle, sUInt32.size))
+        remaps = dict(unpackArray(handle, dRemap, rCount).tolist())
+        complete = True
+    else:
+        complete = unpackEmptyTail(handle, hasWeights == 1)
+    
+    #Writing back a file that was not read to the end would lose data
+    complete = complete and not handle.read(1)
+    
+    return {
+        "lod": lod,
+        "hasWeights": hasWeights == 1,
+        "hasDetailUVs": hasDetailUVs == 1,
+        "position": position,
+        "rotation": rotation,
+        "scale": scale,
+        "vertices": vertices,
+        "normals": normals,
+        "binormals": binormals,
+        "texcoords": texcoords,
+        "detailTexcoords": detailTexcoords,
+        "weights": weights,
+        "faces": faces,
+        "joints": joints,
+        "morphs": morphs,
+        "remaps": remaps,
+        "complete": complete
+    }
+
+def packArray(handle, dtype, array, count = None):
+    #Whole sections are converted and written in one go
+    array = np.ascontiguousarray(array, dtype.base).reshape((-1,) + dtype.shape)
+    if count is not None and len(array) != count:
+        raise LindenMeshError("Mismatched section length!")
+    handle.write(array.tobytes())
+
+def packName(name):
+    name = name.encode()
+    if len(name) > NAME_LENGTH:
+        raise LindenMeshError("Name too long!")
+    return name.ljust(NAME_LENGTH, b"\0")
+
+def packCount(fmt, count):
+    if count >= 1 << (fmt.size * 8):
+        raise LindenMeshError("Too many elements!")
+    return fmt.pack(count)
+
+def packFile(handle, data):
+    #Writes the same structure unpackFile returns, handle only needs write()
+    if not data.get("complete", True):
+        raise LindenMeshError("Mesh was not read to the end, writing it would lose data!")
+    lod = data["lod"]
+    hasWeights = data.get("hasWeights", data["weights"] is not None)
+    hasDetailUVs = data.get("hasDetailUVs", data["detailTexcoords"] is not None)
+    
+    handle.write(sHeader.pack(BINARY_HEADER, int(hasWeights), int(hasDetailUVs),
+        *data["position"], *data["rotation"][:3], int(data["rotation"][3]),
+        *data["scale"]))
+    
+    if not lod:
+        vCount = len(data["vertices"])
+        handle.write(packCount(sUInt16, vCount))
+        packArray(handle, dVec3, data["vertices"], vCount)
+        packArray(handle, dVec3, data["normals"], vCount)
+        packArray(handle, dVec3, data["binormals"], vCount)
+        packArray(handle, dVec2, data["texcoords"], vCount)
+        
+        if hasDetailUVs:
+            packArray(handle, dVec2, data["detailTexcoords"], vCount)
+        
+        if hasWeights:
+            packArray(handle, dFloat, data["weights"], vCount)
+    
+    handle.write(packCount(sUInt16, len(data["faces"])))
+    packArray(handle, dFace, data["faces"])
+    
+    #LOD files still end with empty joint, morph and remap sections
+    joints = []
+    morphs = {}
+    remaps = {}
+    if not lod:
+        joints = data["joints"] or []
+        morphs = data["morphs"] or {}
+        remaps = data["remaps"] or {}
+    
+    if hasWeights:
+        handle.write(packCount(sUInt16, len(joints)))
+        handle.write(b"".join(packName(joint) for joint in joints))
+    
+    for name, morph in morphs.items():
+        records = np.empty(len(morph["indices"]), dMorphVertex)
+        for k in MORPH_COLUMNS:
+            records[k] = morph[k]
+        handle.write(packName(name) + packCount(sUInt32, len(records)))
+        handle.write(records.tobytes())
+    handle.write(packName("End Morphs"))
+    
+    handle.write(packCount(sUInt32, len(remaps)))
+    packArray(handle, dRemap, list(remaps.items()))
+
+def packCache(data, source):
+    #Flat file, a JSON header describing the arrays followed by the raw arrays
+    header = {k:data[k] for k in ("lod", "hasWeights", "hasDetailUVs",
+        "position", "rotation", "scale", "joints", "complete")}
+    header.update(source)
+    header["remaps"] = None
+    if data["remaps"] is not None:
+        header["remaps"] = sorted(data["remaps"].items())
+    
+    arrays = []
+    for k in ("vertices", "normals", "binormals", "texcoords",
+            "detailTexcoords", "weights", "faces"):
+        if data[k] is not None:
+            arrays.append((None, k, data[k]))
+    
+    header["morphs"] = None
+    if data["morphs"] is not None:
+        #Morphs are concatenated per column to keep the number of arrays down
+        morphs = data["morphs"].items()
+        header["morphs"] = [(name, len(morph["indices"])) for name, morph in morphs]
+        for k in MORPH_COLUMNS if header["morphs"] else ():
+            arrays.append(("morphs", k,
+                np.concatenate([morph[k] for name, morph in morphs])))
+    
+    blob = io.BytesIO()
+    header["arrays"] = []
+    for group, k, array in arrays:
+        blob.write(b"\0" * (-blob.tell() % CACHE_ALIGNMENT))
+        header["arrays"].append((group, k, array.dtype.str, array.shape, blob.tell()))
+        blob.write(np.ascontiguousarray(array).tobytes())
+    
+    header = json.dumps(header).encode()
+    return CACHE_HEADER + sUInt32.pack(len(header)) + header + blob.getvalue()
+
+def unpackCache(buffer):
+    if buffer[:len(CACHE_HEADER)] != CACHE_HEADER:
+        raise LindenMeshError("Invalid Cache Header!")
+    
+    offset = len(CACHE_HEADER) + sUInt32.size
+    length, = sUInt32.unpack_from(buffer, len(CACHE_HEADER))
+    header = json.loads(buffer[offset:offset + length])
+    offset += length
+    
+    data = {k:header[k] for k in ("lod", "hasWeights", "hasDetailUVs", "joints", "complete")}
+    for k in ("position", "rotation", "scale"):
+        data[k] = tuple(header[k])
+    for k in ("vertices", "normals", "binormals", "texcoords",
+            "detailTexcoords", "weights", "faces"):
+        data[k] = None
+    
+    data["remaps"] = None
+    if header["remaps"] is not None:
+        data["remaps"] = dict(header["remaps"])
+    
+    columns = {}
+    for group, k, dtype, shape, start in header["arrays"]:
+        dtype = np.dtype(dtype)
+        count = math.prod(shape)
+        if offset + start + dtype.itemsize * count > len(buffer):
+            raise LindenMeshError("Unexpected end of file!")
+        array = np.frombuffer(buffer, dtype, count, offset + start).reshape(shape)
+        if group is None:
+            data[k] = array
+        else:
+            columns[k] = array
+    
+    data["morphs"] = None
+    if header["morphs"] is not None:
+        data["morphs"] = {}
+        start = 0
+        for name, count in header["morphs"]:
+            data["morphs"][name] = {k:columns[k][start:start + count]
+                for k in MORPH_COLUMNS}
+            start += count
+    
+    return header, data
+
+class LindenMeshCache:
+    def __init__(self, path = cache_path, maxSize = 256 * 1024 * 1024):
+        #Disk cache of decoded meshes, disabled if path is None
+        self.path = path
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+    
+    def entryPath(self, source, lod = 0):
+        key = "{}:{}".format(os.path.realpath(source), lod).encode()
+        return os.path.join(self.path, hashlib.sha1(key).hexdigest() + ".cache")
+    
+    def entries(self):
+        try:
+            with os.scandir(self.path) as it:
+                return [e for e in it if e.is_file() and e.name.endswith(".cache")]
+        except OSError:
+            return []
+    
+    def get(self, source, lod = 0):
+        if not self.path:
+            return None
+        
+        entry = self.entryPath(source, lod)
+        try:
+            stat = os.stat(source)
+            with open(entry, "rb") as f:
+                header, data = unpackCache(f.read())
+            touched = header["size"] != stat.st_size or header["mtime"] != stat.st_mtime_ns
+            expected = header["hash"]
+        except Exception:
+            #The cache is only an optimization, a bad entry means decoding again
+            self.misses += 1
+            return None
+        
+        if touched:
+            #The file was touched, only throw the entry out if the content changed
+            try:
+                with open(source, "rb") as f:
+                    digest = hashlib.sha1(f.read()).hexdigest()
+            except OSError:
+                digest = None
+            if digest != expected:
+                self.invalidate(source, lod)
+                self.misses += 1
+                return None
+            self.put(source, lod, data, digest)
+        
+        try:
+            #Entries are evicted least recently used first
+            os.utime(entry)
+        except OSError:
+            pass
+        
+        self.hits += 1
+        return data
+    
+    def put(self, source, lod, data, digest):
+        if not self.path:
+            return
+        
+        try:
+            stat = os.stat(source)
+            buffer = packCache(data, {
+                "source": os.path.realpath(source),
+                "size": stat.st_size,
+                "mtime": stat.st_mtime_ns,
+                "hash": digest
+            })
+            
+            if len(buffer) > self.maxSize:
+                return
+            
+            os.makedirs(self.path, exist_ok=True)
+            entry = self.entryPath(source, lod)
+            temp = "{}.{}.{}.tmp".format(entry, os.getpid(), threading.get_ident())
+            with open(temp, "wb") as f:
+                f.write(buffer)
+            os.replace(temp, entry)
+        except OSError:
+            #The cache is only an optimization
+            return
+        
+        self.evict()
+    
+    def evict(self):
+        entries = []
+        for e in self.entries():
+            try:
+                stat = e.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, e.path))
+        
+        total = sum(e[1] for e in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.maxSize:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+    
+    def invalidate(self, source = None, lod = 0):
+        if not self.path:
+            return
+        
+        if source is None:
+            paths = [e.path for e in self.entries()]
+        else:
+            paths = [self.entryPath(source, lod)]
+        
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    
+    def clear(self):
+        self.invalidate()
+        self.hits = 0
+        self.misses = 0
+    
+    def warm(self, paths = None):
+        #Decode and store meshes ahead of time, defaults to the bundled ones
+        if paths is None:
+            paths = sorted(os.path.join(asset_path, f)
+                for f in os.listdir(asset_path) if f.endswith(".llm"))
+        
+        for path in paths:
+            loadFile(path, lodFromPath(path), cache = self)
+
+meshCache = LindenMeshCache()
+
+def loadFile(path, lod = 0, mapped = False, cache = None):
+    if mapped:
+        with open(path, "rb") as f:
+            return unpackFile(mapFile(f), lod)
+    
+    cache = cache or meshCache
+    data = cache.get(path, lod)
+    if data is not None:
+        return data
+    
+    with open(path, "rb") as f:
+        raw = f.read()
+    
+    data = unpackFile(io.BytesIO(raw), lod)
+    cache.put(path, lod, data, hashlib.sha1(raw).hexdigest())
+    return data
+
+class LindenMeshMorph:
+    __slots__ = ("parent", "_index", "_indices", "_vertices", "_normals",
+        "_binormals", "_texcoords")
+    
+    def __init__(self, parent):
+        self.parent = parent
+        self._index = None
+        self._indices = np.empty(0, dMorphVertex["indices"])
+        self._vertices = np.empty(0, dMorphVertex["vertices"])
+        self._normals = np.empty(0, dMorphVertex["normals"])
+        self._binormals = np.empty(0, dMorphVertex["binormals"])
+        self._texcoords = np.empty(0, dMorphVertex["texcoords"])
+    
+    @classmethod
+    def load(cls, data, parent):
+        self = cls(parent)
+        if "offset" in data:
+            #Mapped, decoded on first access
+            self._index = data
+        else:
+            self.setData(data)
+        return self
+    
+    def setData(self, data):
+        self._indices = data["indices"]
+        self._vertices = data["vertices"]
+        self._normals = data["normals"]
+        self._binormals = data["binormals"]
+        self._texcoords = data["texcoords"]
+    
+    def decode(self):
+        if self._index is not None:
+            records = np.frombuffer(self._index["buffer"], dMorphVertex,
+                self._index["count"], self._index["offset"])
+            self.setData(unpackMorph(records))
+            self._index = None
+    
+    @property
+    def indices(self):
+        self.decode()
+        return self._indices
+    
+    @property
+    def vertices(self):
+        self.decode()
+        return self._vertices
+    
+    @property
+    def normals(self):
+        self.decode()
+        return self._normals
+    
+    @property
+    def binormals(self):
+        self.decode()
+        return self._binormals
+    
+    @property
+    def texcoords(self):
+        self.decode()
+        return self._texcoords
+
+class LindenMeshLOD:
+    #Vertex data are numpy arrays, (N,3) float32 for vectors, (N,2) float32
+    #for texture coordinates, (N,) float32 weights and (N,3) uint16 faces
+    __slots__ = ("parent", "lod", "position", "rotation", "scale", "faces", "complete",
+        "_vertices", "_normals", "_binormals", "_texcoords", "_detailTexcoords",
+        "_weights", "_joints", "_morphs", "_remaps")
+    
+    def __init__(self, parent):
+        self.parent = parent
+        self.lod = 0
+        self.position = (0,0,0)
+        self.rotation = (0,0,0,0)
+        self.scale = (0,0,0)
+        self.faces = np.empty(0, dFace)
+        self.complete = True
+        #Proxied, None falls back to LOD 0
+        self._vertices = None
+        self._normals = None
+        self._binormals = None
+        self._texcoords = None
+        self._detailTexcoords = None
+        self._weights = None
+        self._joints = None
+        self._morphs = None
+        self._remaps = None
+    
+    @classmethod
+    def load(cls, data, parent):
+        self = cls(parent)
+        self.lod = data["lod"]
+        self.position = data["position"]
+        self.rotation = data["rotation"]
+        self.scale = data["scale"]
+        self.faces = data["faces"]
+        self.complete = data.get("complete", True)
+        
+        #Proxied
+        self._vertices = data["vertices"]
+        self._normals = data["normals"]
+        self._binormals = data["binormals"]
+        self._texcoords = data["texcoords"]
+        self._detailTexcoords = data["detailTexcoords"]
+        self._weights = data["weights"]
+        self._joints = data["joints"]
+        self._morphs = None
+        if data["morphs"] is not None:
+            self._morphs = {k:LindenMeshMorph.load(v, self) for k,v in data["morphs"].items()}
+        self._remaps = data["remaps"]
+        
+        return self
+    
+    def dump(self):
+        #Same structure as unpackFile, LODs only carry their own faces
+        data = {
+            "lod": self.lod,
+            "hasWeights": self.weights is not None,
+            "hasDetailUVs": self.detailTexcoords is not None,
+            "position": self.position,
+            "rotation": self.rotation,
+            "scale": self.scale,
+            "faces": self.faces,
+            "complete": self.complete
+        }
+        for k in ("vertices", "normals", "binormals", "texcoords",
+                "detailTexcoords", "weights", "joints", "remaps"):
+            data[k] = getattr(self, k) if not self.lod else None
+        
+        data["morphs"] = None
+        if not self.lod:
+            data["morphs"] = {name:{k:getattr(morph, k) for k in MORPH_COLUMNS}
+                for name, morph in self.morphs.items()}
+        return data
+    
+    def save(self, handle):
+        packFile(handle, self.dump())
+    
+    @property
+    def vertices(self):
+        if self._vertices is not None:
+            return self._vertices
+        return self.parent.lods[0]._vertices
+    
+    @property
+    def normals(self):
+        if self._normals is not None:
+            return self._normals
+        return self.parent.lods[0]._normals
+    
+    @property
+    def binormals(self):
+        if self._binormals is not None:
+            return self._binormals
+        return self.parent.lods[0]._binormals
+    
+    @property
+    def texcoords(self):
+        if self._texcoords is not None:
+            return self._texcoords
+        return self.parent.lods[0]._texcoords
+    
+    @property
+    def detailTexcoords(self):
+        if self._detailTexcoords is not None:
+            return self._detailTexcoords
+        return self.parent.lods[0]._detailTexcoords
+    
+    @property
+    def weights(self):
+        if self._weights is not None:
+            return self._weights
+        return self.parent.lods[0]._weights
+    
+    @property
+    def joints(self):
+        if self._joints is not None:
+            return self._joints
+        return self.parent.lods[0]._joints
+    
+    @property
+    def morphs(self):
+        if self._morphs is not None:
+            return self._morphs
+        return self.parent.lods[0]._morphs
+    
+    @property
+    def remaps(self):
+        if self._remaps is not None:
+            return self._remaps
+        return self.parent.lods[0]._remaps
+
+
+class LindenMeshPool:
+    __slots__ = ("maxSize", "hits", "misses", "meshes", "lock")
+    
+    def __init__(self, maxSize = 32):
+        #Loaded meshes shared between callers, least recently used are dropped
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        self.meshes = collections.OrderedDict()
+        self.lock = threading.Lock()
+    
+    def get(self, key, stamp):
+        with self.lock:
+            entry = self.meshes.get(key)
+            if entry is None or entry[0] != stamp:
+                self.misses += 1
+                return None
+            self.meshes.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+    
+    def put(self, key, stamp, mesh):
+        with self.lock:
+            self.meshes[key] = (stamp, mesh)
+            self.meshes.move_to_end(key)
+            while len(self.meshes) > self.maxSize:
+                self.meshes.popitem(last=False)
+    
+    def clear(self):
+        with self.lock:
+            self.meshes.clear()
+            self.hits = 0
+            self.misses = 0
+
+meshPool = LindenMeshPool()
+
+lodIndex = {}
+
+def findLODs(path):
+    #LODs are stored next to the mesh as name_1.llm, name_2.llm and so on
+    #Each directory is only listed again once it has changed
+    directory, name = os.path.split(path)
+    directory = directory or "."
+    mtime = os.stat(directory).st_mtime_ns
+    
+    entry = lodIndex.get(directory)
+    if entry is None or entry[0] != mtime:
+        found = collections.defaultdict(set)
+        for f in os.listdir(directory):
+            if not f.endswith(".llm"):
+                continue
+            base, _, lod = f[:-4].rpartition("_")
+            if base and lod.isdigit():
+                found[base].add(int(lod))
+        
+        index = {}
+        for base, lods in found.items():
+            index[base] = []
+            while len(index[base]) + 1 in lods:
+                index[base].append(len(index[base]) + 1)
+        
+        entry = (mtime, index)
+        lodIndex[directory] = entry
+    
+    return list(entry[1].get(name, []))
+
+class LindenMeshLODs:
+    #Sequence of a mesh's LODs, each one is only read when first accessed
+    __slots__ = ("parent", "files", "mapped", "loaded", "lock")
+    
+    def __init__(self, parent, files = (), mapped = False):
+        self.parent = parent
+        self.files = list(files)
+        self.mapped = mapped
+        self.loaded = [None] * len(self.files)
+        self.lock = threading.RLock()
+    
+    def prefetch(self, executor):
+        with self.lock:
+            for i, (path, lod) in enumerate(self.files):
+                if self.loaded[i] is None:
+                    self.loaded[i] = executor.submit(loadFile, path, lod, self.mapped)
+    
+    def append(self, lod):
+        with self.lock:
+            self.files.append(None)
+            self.loaded.append(lod)
+    
+    def isLoaded(self, index):
+        return isinstance(self.loaded[index], LindenMeshLOD)
+    
+    def __len__(self):
+        return len(self.loaded)
+    
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        
+        lod = self.loaded[index]
+        if isinstance(lod, LindenMeshLOD):
+            return lod
+        
+        with self.lock:
+            lod = self.loaded[index]
+            if lod is None:
+                path, i = self.files[index]
+                lod = LindenMeshLOD.load(loadFile(path, i, self.mapped), self.parent)
+            elif isinstance(lod, concurrent.futures.Future):
+                lod = LindenMeshLOD.load(lod.result(), self.parent)
+            self.loaded[index] = lod
+        return lod
+
+class LindenMesh:
+    __slots__ = ("name", "lods")
+    
+    def __init__(self, name):
+        self.name = name
+        self.lods = LindenMeshLODs(self)
+    
+    @classmethod
+    def load(cls, path, loadLODs = False, mapped = False, shared = True, executor = None):
+        #Mapped meshes keep the file mapped and reference it instead of copying
+        #Shared meshes are handed out to every caller, so don't modify them
+        #LODs are read on first access, unless an executor is given to read
+        #them concurrently up front
+        if shared:
+            stat = os.stat(path+".llm")
+            key = (cls, os.path.realpath(path), loadLODs, mapped)
+            stamp = (stat.st_size, stat.st_mtime_ns)
+            self = meshPool.get(key, stamp)
+            if self is not None:
+                return self
+        
+        self = cls(os.path.split(path)[-1])
+        
+        files = [(path+".llm", 0)]
+        if loadLODs:
+            files += [(path+"_{}.llm".format(i), i) for i in findLODs(path)]
+        
+        self.lods = LindenMeshLODs(self, files, mapped)
+        if executor:
+            self.lods.prefetch(executor)
+        
+        #Always needed, and surfaces a missing mesh straight away
+        self.lods[0]
+        
+        if shared:
+            meshPool.put(key, stamp, self)
+        
+        return self
+    
+    def save(self, path, saveLODs = True):
+        #Everything is packed before any file is opened, so a LOD that can't
+        #be written leaves all the files alone
+        buffers = []
+        for i in range(len(self.lods) if saveLODs else 1):
+            buffer = io.BytesIO()
+            self.lods[i].save(buffer)
+            buffers.append(buffer.getvalue())
+        
+        for i, buffer in enumerate(buffers):
+            with open(path+(".llm" if not i else "_{}.llm".format(i)), "wb") as f:
+                f.write(buffer)
+
+def loadMeshes(paths, loadLODs = False, mapped = False, shared = True, workers = None):
+    #Read and decode meshes in worker threads, returned in the same order as paths
+    #Repeated paths are only loaded once and get the same LindenMesh
+    unique = list(dict.fromkeys(paths))
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor, \
+     concurrent.futures.ThreadPoolExecutor(workers) as lodExecutor:
+        futures = {path:executor.submit(LindenMesh.load, path, loadLODs, mapped,
+            shared, lodExecutor if loadLODs else None) for path in unique}
+        meshes = {path:future.result() for path, future in futures.items()}
+    return [meshes[path] for path in paths]
+
+if __name__ == "__main__":
+    #Benchmark and round-trip the bundled meshes, this doesn't need Blender
+    import glob
+    import time
+    
+    def nameOffsets(data):
+        #Where packFile puts the joint and morph names, only the bytes up to
+        #the first NUL of a name are data, the rest is padding
+        offsets = []
+        if data["lod"]:
+            return offsets
+        vCount = len(data["vertices"])
+        offset = sHeader.size + sUInt16.size + vCount * (dVec3.itemsize * 3 + dVec2.itemsize)
+        if data["hasDetailUVs"]:
+            offset += vCount * dVec2.itemsize
+        if data["hasWeights"]:
+            offset += vCount * dFloat.itemsize
+        offset += sUInt16.size + len(data["faces"]) * dFace.itemsize
+        if data["hasWeights"]:
+            offset += sUInt16.size
+            for joint in data["joints"]:
+                offsets.append(offset)
+                offset += NAME_LENGTH
+        for morph in data["morphs"].values():
+            offsets.append(offset)
+            offset += NAME_LENGTH + sUInt32.size + dMorphVertex.itemsize * len(morph["indices"])
+        offsets.append(offset)
+        return offsets
+    
+    def withoutPadding(raw, offsets):
+        raw = bytearray(raw)
+        for offset in offsets:
+            end = raw.find(b"\0", offset, offset + NAME_LENGTH)
+            if end >= 0:
+                raw[end:offset + NAME_LENGTH] = bytes(offset + NAME_LENGTH - end)
+        return bytes(raw)
+    
+    def sameBytes(written, raw, data):
+        offsets = nameOffsets(data)
+        return withoutPadding(written, offsets) == withoutPadding(raw, offsets)
+    
+    def refused(data):
+        #Files that were not read to the end must not be written back
+        try:
+            packFile(io.BytesIO(), data)
+        except LindenMeshError:
+            return True
+        return False
+    
+    print("{:<28}{:>12}{:>12}{:>12}".format("Mesh", "Read", "Write", "Write MB/s"))
+    totalRead = 0
+    totalWrite = 0
+    totalSize = 0
+    incomplete = []
+    for path in sorted(glob.glob(os.path.join(asset_path, "*.llm"))):
+        name = os.path.basename(path)[:-4]
+        lod = lodFromPath(path)
+        with open(path, "rb") as f:
+            raw = f.read()
+        
+        start = time.perf_counter()
+        data = unpackFile(io.BytesIO(raw), lod)
+        readTime = time.perf_counter() - start
+        
+        if not data["complete"]:
+            if not refused(data):
+                raise LindenMeshError("{} was not read to the end but was written!".format(name))
+            incomplete.append(name)
+            continue
+        
+        out = io.BytesIO()
+        start = time.perf_counter()
+        packFile(out, data)
+        writeTime = time.perf_counter() - start
+        written = out.getvalue()
+        
+        #Byte for byte, apart from what follows the NUL in names
+        if not sameBytes(written, raw, data):
+            raise LindenMeshError("Round-trip mismatch in {}!".format(name))
+        
+        totalRead += readTime
+        totalWrite += writeTime
+        totalSize += len(written)
+        print("{:<28}{:>10.3f}ms{:>10.3f}ms{:>12.1f}".format(name, readTime * 1000,
+            writeTime * 1000, len(written) / writeTime / 1e6))
+    print("{:<28}{:>10.3f}ms{:>10.3f}ms{:>12.1f}".format("Total", totalRead * 1000,
+        totalWrite * 1000, totalSize / totalWrite / 1e6))
+    for name in incomplete:
+        print("{}: not read to the end, writing it is refused".format(name))
+    
+    #The same through LindenMesh.load and save
+    import tempfile
+    with tempfile.TemporaryDirectory() as temp:
+        for path in sorted(glob.glob(os.path.join(asset_path, "*.llm"))):
+            if lodFromPath(path):
+                continue
+            base = path[:-4]
+            name = os.path.basename(base)
+            mesh = LindenMesh.load(base, loadLODs=True, shared=False)
+            if any(not lod.complete for lod in mesh.lods):
+                if not all(refused(lod.dump()) for lod in mesh.lods if not lod.complete):
+                    raise LindenMeshError("{} was not read to the end but was written!".format(name))
+                try:
+                    mesh.save(os.path.join(temp, name))
+                except LindenMeshError:
+                    pass
+                if os.listdir(temp):
+                    raise LindenMeshError("Refused save of {} still wrote files!".format(name))
+                continue
+            
+            mesh.save(os.path.join(temp, name))
+            for i, lod in enumerate(mesh.lods):
+                suffix = ".llm" if not i else "_{}.llm".format(i)
+                with open(base + suffix, "rb") as f:
+                    raw = f.read()
+                with open(os.path.join(temp, name + suffix), "rb") as f:
+                    written = f.read()
+                if not sameBytes(written, raw, lod.dump()):
+                    raise LindenMeshError("LindenMesh round-trip mismatch in {}{}!".format(name, suffix))
+                os.remove(os.path.join(temp, name + suffix))
+    print("LindenMesh load and save round-trip OK")
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+import numpy as np
+
+MORPH_ATTRIBUTES = ("vertices", "normals", "binormals", "texcoords")
+
+class LindenMeshMorphEngine:
+    #Evaluates any mix of a mesh's morphs without Blender
+    #All morphs are packed into flat arrays, entry i moves vertex indices[i]
+    #by deltas[k][i] scaled by the weight of morph owners[i]
+    __slots__ = ("names", "index", "offsets", "owners", "indices", "deltas", "base")
+    
+    def __init__(self, mesh, lod = 0):
+        lod = mesh.lods[lod]
+        morphs = lod.morphs or {}
+        
+        self.names = list(morphs.keys())
+        self.index = {name:i for i, name in enumerate(self.names)}
+        
+        counts = np.array([len(m.indices) for m in morphs.values()], dtype=np.intp)
+        self.offsets = np.concatenate(([0], np.cumsum(counts)))
+        self.owners = np.repeat(np.arange(len(self.names), dtype=np.intp), counts)
+        self.indices = np.concatenate(
+            [np.asarray(m.indices, np.intp) for m in morphs.values()]
+            or [np.empty(0, np.intp)])
+        
+        self.base = {}
+        self.deltas = {}
+        for k in MORPH_ATTRIBUTES:
+            base = np.ascontiguousarray(getattr(lod, k), np.float32)
+            self.base[k] = base
+            self.deltas[k] = np.concatenate(
+                [np.asarray(getattr(m, k), np.float32) for m in morphs.values()]
+                or [np.empty((0,) + base.shape[1:], np.float32)])
+    
+    def weightVector(self, weights):
+        #Morph name to weight mapping to a weight per morph
+        vector = np.zeros(len(self.names), dtype=np.float32)
+        for name, value in weights.items():
+            vector[self.index[name]] = value
+        return vector
+    
+    def evaluate(self, weights, normalize = True):
+        #Returns deformed copies of the vertices, normals, binormals and texcoords
+        weights = self.weightVector(weights)[self.owners]
+        active = np.flatnonzero(weights)
+        indices = self.indices[active]
+        weights = weights[active]
+        
+        result = {}
+        for k, base in self.base.items():
+            deltas = self.deltas[k][active] * weights[:, None]
+            out = base.copy()
+            for c in range(base.shape[1]):
+                out[:, c] += np.bincount(indices, deltas[:, c], len(base))
+            result[k] = out
+        
+        if normalize:
+            for k in ("normals", "binormals"):
+                length = np.linalg.norm(result[k], axis=1, keepdims=True)
+                np.divide(result[k], length, out=result[k], where=length > 0)
+        
+        return result
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+import os
+import collections
+import numpy as np
+from . import sl_lad
+from . import sl_cache
+from . import sl_shape
+
+lad_path = sl_lad.lad_path
+
+#Param id the viewer takes the avatar's sex from
+SEX_PARAM = 80
+
+PARAM_KINDS = {
+    "param_morph": "morph",
+    "param_driver": "driver",
+    "param_color": "color",
+    "param_alpha": "alpha",
+    "param_skeleton": "skeleton"
+}
+
+#Where a param's value ends up: ("mesh", type), ("layer_set", body_region),
+#("global_color", name) or ("skeleton",)
+VisualParam = collections.namedtuple("VisualParam", (
+    "id", "name", "kind", "wearable", "sex",
+    "minimum", "maximum", "default", "outputs", "driven"
+))
+
+#Driven weight ramps from the driven param's minimum at min1 to its maximum
+#at max1, holds until max2 and ramps back down to its minimum at min2
+DrivenEntry = collections.namedtuple("DrivenEntry", ("id", "min1", "max1", "max2", "min2"))
+
+class VisualParamError(Exception):
+    pass
+
+def parseVisualParams(path = lad_path):
+    #Every param in the file, params defined in several places are merged
+    #and keep the attributes of their first definition
+    lad = sl_lad.loadLAD(path)
+    params = {}
+    meshFiles = {type:os.path.splitext(lods[0]["file_name"])[0] for type, lods in lad.meshes.items()}
+    
+    for definition in lad.params:
+        kind = PARAM_KINDS.get(definition["kind"])
+        if kind is None:
+            continue
+        
+        owner = definition["owner"]
+        if owner[0] == "driver":
+            output = None
+        elif owner[0] == "layer_set":
+            output = ("layer_set", owner[1])
+        else:
+            output = tuple(owner)
+        
+        id = definition["id"]
+        if id in params:
+            if output is not None and output not in params[id].outputs:
+                params[id] = params[id]._replace(outputs=params[id].outputs + (output,))
+            continue
+        
+        attrib = definition["attrib"]
+        minimum = float(attrib.get("value_min", 0))
+        maximum = float(attrib.get("value_max", 1))
+        driven = ()
+        if kind == "driver":
+            driven = tuple(DrivenEntry(
+                int(d["id"]),
+                float(d.get("min1", minimum)),
+                float(d.get("max1", maximum)),
+                float(d.get("max2", maximum)),
+                float(d.get("min2", maximum))
+            ) for tag, d in definition["body"] if tag == "driven")
+        
+        params[id] = VisualParam(
+            id = id,
+            name = attrib["name"],
+            kind = kind,
+            wearable = attrib.get("wearable"),
+            sex = attrib.get("sex"),
+            minimum = minimum,
+            maximum = maximum,
+            default = min(max(float(attrib.get("value_default", 0)), minimum), maximum),
+            outputs = () if output is None else (output,),
+            driven = driven
+        )
+    
+    return params, meshFiles
+
+def drivenWeight(entry, weight, minimum, maximum, driverMinimum, driverMaximum):
+    #Same piecewise ramp as the viewer's LLDriverParam::getDrivenWeight,
+    #minimum and maximum are the driven param's range, the edge cases check
+    #against the driver's own range
+    if weight <= entry.min1:
+        if entry.min1 == entry.max1 and entry.min1 <= driverMinimum:
+            return maximum
+        return minimum
+    if weight <= entry.max1:
+        t = (weight - entry.min1) / (entry.max1 - entry.min1)
+        return minimum + t * (maximum - minimum)
+    if weight <= entry.max2:
+        return maximum
+    if weight <= entry.min2:
+        t = (weight - entry.max2) / (entry.min2 - entry.max2)
+        return maximum + t * (minimum - maximum)
+    if entry.max2 >= driverMaximum:
+        return maximum
+    return minimum
+
+class VisualParamGraph:
+    #Drivers point at the params they drive, the outputs hang off the params
+    #downstream(id) is everything a change to id can reach, in evaluation order
+    __slots__ = ("params", "index", "meshFiles", "order", "rank", "owners", "sexOwners", "downstreamCache")
+    
+    def __init__(self, params, meshFiles = None):
+        self.params = params
+        self.meshFiles = meshFiles or {}
+        for param in params.values():
+            for entry in param.driven:
+                if entry.id not in params:
+                    raise VisualParamError("Param {} drives missing param {}".format(param.id, entry.id))
+        
+        #Kahn's algorithm, anything left over is part of a cycle
+        incoming = collections.Counter(e.id for p in params.values() for e in p.driven)
+        ready = collections.deque(sorted(id for id in params if not incoming[id]))
+        self.order = []
+        while ready:
+            id = ready.popleft()
+            self.order.append(id)
+            for entry in params[id].driven:
+                incoming[entry.id] -= 1
+                if not incoming[entry.id]:
+                    ready.append(entry.id)
+        if len(self.order) != len(params):
+            cycle = sorted(id for id in params if incoming[id])
+            raise VisualParamError("Driver cycle through params {}".format(cycle))
+        self.rank = {id:i for i, id in enumerate(self.order)}
+        
+        #Drivers share their name with what they drive, names go to the driver
+        self.index = {}
+        for id in self.order:
+            self.index[id] = id
+            self.index.setdefault(params[id].name, id)
+        
+        self.owners = collections.defaultdict(list)
+        for id in self.order:
+            for output in params[id].outputs:
+                self.owners[output].append(id)
+        self.sexOwners = {o for p in params.values() if p.sex for o in p.outputs}
+        self.downstreamCache = {}
+    
+    def __len__(self):
+        return len(self.params)
+    
+    def resolve(self, key):
+        try:
+            return self.index[key]
+        except KeyError:
+            raise VisualParamError("Unknown param {!r}".format(key)) from None
+    
+    def downstream(self, id):
+        result = self.downstreamCache.get(id)
+        if result is None:
+            seen = {id}
+            stack = [id]
+            while stack:
+                for entry in self.params[stack.pop()].driven:
+                    if entry.id not in seen:
+                        seen.add(entry.id)
+                        stack.append(entry.id)
+            result = tuple(sorted(seen, key=self.rank.__getitem__))
+            self.downstreamCache[id] = result
+        return result
+
+class VisualParamState:
+    #Param values of one avatar, setting a value only reevaluates the params
+    #and outputs downstream of it, other outputs stay cached
+    __slots__ = ("graph", "values", "dirty", "cache", "shapeEngine")
+    
+    def __init__(self, graph, values = None):
+        self.graph = graph
+        self.values = {id:p.default for id, p in graph.params.items()}
+        self.dirty = set(graph.owners)
+        self.cache = {}
+        self.shapeEngine = None
+        for id in graph.order:
+            if graph.params[id].driven:
+                self.propagate(id)
+        if values:
+            self.update(values)
+    
+    def __getitem__(self, key):
+        return self.values[self.graph.resolve(key)]
+    
+    def __setitem__(self, key, value):
+        self.set(key, value)
+    
+    @property
+    def male(self):
+        return self.values.get(SEX_PARAM, 0) > 0.5
+    
+    def effective(self, id):
+        #Params for the other sex stay at their default
+        param = self.graph.params[id]
+        if param.sex and (param.sex == "male") != self.male:
+            return param.default
+        return self.values[id]
+    
+    def propagate(self, id):
+        param = self.graph.params[id]
+        weight = self.values[id]
+        changed = []
+        for entry in param.driven:
+            driven = self.graph.params[entry.id]
+            value = drivenWeight(entry, weight, driven.minimum, driven.maximum, param.minimum, param.maximum)
+            if self.values[entry.id] != value:
+                self.values[entry.id] = value
+                changed.append(entry.id)
+        return changed
+    
+    def set(self, key, value):
+        #Returns the ids whose value changed, the set one first
+        id = self.graph.resolve(key)
+        param = self.graph.params[id]
+        value = min(max(float(value), param.minimum), param.maximum)
+        if self.values[id] == value:
+            return ()
+        
+        sex = self.male
+        self.values[id] = value
+        changed = {id}
+        for node in self.graph.downstream(id):
+            if node in changed and self.graph.params[node].driven:
+                changed.update(self.propagate(node))
+        
+        for node in changed:
+            self.dirty.update(self.graph.params[node].outputs)
+        if self.male != sex:
+            self.dirty.update(self.graph.sexOwners)
+        return tuple(sorted(changed, key=self.graph.rank.__getitem__))
+    
+    def update(self, values):
+        changed = []
+        for key, value in values.items():
+            changed.extend(self.set(key, value))
+        return changed
+    
+    def output(self, owner):
+        #Cached until one of the params feeding it changes
+        if owner in self.dirty or owner not in self.cache:
+            if owner[0] == "skeleton":
+                self.cache[owner] = self.evaluateSkeleton()
+            else:
+                self.cache[owner] = {self.graph.params[id].name:self.effective(id)
+                    for id in self.graph.owners[owner]}
+            self.dirty.discard(owner)
+        return self.cache[owner]
+    
+    def evaluateSkeleton(self):
+        #Joint scales and positions, see sl_shape.SkeletonShapeEngine
+        if self.shapeEngine is None:
+            self.shapeEngine = sl_shape.loadShapeEngine()
+        engine = self.shapeEngine
+        weights = np.array([self.values.get(int(id), d) for id, d in zip(engine.ids, engine.defaults)])
+        return engine.evaluate(weights, self.male)
+    
+    def morphWeights(self, mesh):
+        return self.output(("mesh", mesh))
+    
+    def skeleton(self):
+        return self.output(("skeleton",))
+    
+    def flush(self):
+        #Reevaluates every stale output and returns them by owner
+        return {owner:self.output(owner) for owner in list(self.dirty)}
+
+loaded = sl_cache.Memo()
+
+def loadParamGraph(path = lad_path):
+    #Compiled once per file and shared by every VisualParamState
+    return loaded.get(path, sl_cache.fileStamp(path), lambda: VisualParamGraph(*parseVisualParams(path)))
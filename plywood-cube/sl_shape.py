@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+import numpy as np
+from . import sl_lad
+from . import sl_skeleton_table
+from . import sl_cache
+
+lad_path = sl_lad.lad_path
+
+def parseVector(value):
+    return [float(i) for i in value.split()]
+
+class SkeletonShapeEngine:
+    #Evaluates the param_skeleton entries of avatar_lad.xml
+    #Each param adds weight * scale to a joint's scale and weight * offset to
+    #its position, so all of them together are one matrix product:
+    #scales = base + weights @ scaleCoeffs, positions = base + weights @ offsetCoeffs
+    __slots__ = ("skeleton", "ids", "names", "index", "defaults", "minimums", "maximums",
+        "maleOnly", "scaleCoeffs", "offsetCoeffs", "scales", "positions")
+    
+    def __init__(self, path = lad_path, skeleton = None):
+        self.skeleton = sl_skeleton_table.loadSkeletonArrays() if skeleton is None else skeleton
+        bones = self.skeleton.index
+        
+        params = [p for p in sl_lad.loadLAD(path).params if p["kind"] == "param_skeleton"]
+        
+        self.ids = np.array([p["id"] for p in params], dtype=np.int32)
+        self.names = tuple(p["attrib"]["name"] for p in params)
+        self.index = {}
+        for i, param in enumerate(params):
+            self.index[param["id"]] = i
+            self.index[param["attrib"]["name"]] = i
+        self.defaults = np.array([float(p["attrib"].get("value_default", 0)) for p in params], dtype=np.float64)
+        self.minimums = np.array([float(p["attrib"].get("value_min", 0)) for p in params], dtype=np.float64)
+        self.maximums = np.array([float(p["attrib"].get("value_max", 1)) for p in params], dtype=np.float64)
+        self.maleOnly = np.array([p["attrib"].get("sex") == "male" for p in params], dtype=bool)
+        
+        count = len(self.skeleton)
+        self.scaleCoeffs = np.zeros((len(params), count * 3), dtype=np.float64)
+        self.offsetCoeffs = np.zeros((len(params), count * 3), dtype=np.float64)
+        for i, param in enumerate(params):
+            for tag, bone in param["body"]:
+                joint = bones.get(bone["name"]) if tag == "bone" else None
+                if joint is None:
+                    continue
+                if "scale" in bone:
+                    self.scaleCoeffs[i, joint * 3:joint * 3 + 3] += parseVector(bone["scale"])
+                if "offset" in bone:
+                    self.offsetCoeffs[i, joint * 3:joint * 3 + 3] += parseVector(bone["offset"])
+        
+        self.scales = self.skeleton.scales.reshape(-1)
+        self.positions = self.skeleton.positions.reshape(-1)
+    
+    def __len__(self):
+        return len(self.names)
+    
+    def weightVector(self, values = None):
+        #Param id or name to value mapping to a clamped value per param,
+        #params that are not given keep their default
+        vector = self.defaults.copy()
+        for key, value in (values or {}).items():
+            vector[self.index[key]] = value
+        return np.clip(vector, self.minimums, self.maximums)
+    
+    def evaluate(self, weights, male = False):
+        #weights is one weightVector or a stack of them, shape (..., params)
+        #Returns the joint scales and positions, shape (..., joints, 3)
+        weights = np.asarray(weights, np.float64)
+        if not male:
+            #Male only params stay at their default on female shapes
+            weights = np.where(self.maleOnly, self.defaults, weights)
+        
+        shape = weights.shape[:-1] + (len(self.skeleton), 3)
+        scales = (self.scales + weights @ self.scaleCoeffs).reshape(shape)
+        positions = (self.positions + weights @ self.offsetCoeffs).reshape(shape)
+        return scales, positions
+    
+    def worldMatrices(self, weights, male = False):
+        #Like the viewer's joints, scale is not inherited but a child's offset
+        #is scaled by its parent's own scale
+        scales, positions = self.evaluate(weights, male)
+        parents = self.skeleton.parents
+        parentScales = np.where(parents[:, None] >= 0, scales[..., parents, :], 1.0)
+        local = self.skeleton.localMatrices(positions=positions * parentScales, scales=np.ones(3))
+        world = self.skeleton.worldMatrices(local)
+        world[..., :3, :3] *= scales[..., None, :]
+        return world
+
+loaded = sl_cache.Memo()
+
+def loadShapeEngine(path = lad_path):
+    #Parsed once per skeleton table, the coefficient arrays are shared
+    skeleton = sl_skeleton_table.loadSkeletonArrays()
+    return loaded.get(path, skeleton, lambda: SkeletonShapeEngine(path, skeleton))
@@ -9,32 +9,30 @@ import bpy.props
 from bpy_extras.object_utils import AddObjectHelper, object_data_add
 from mathutils import Vector
 import xml.etree.ElementTree as ET
+import numpy as np
+from . import sl_skeleton_table
 
 
 def get_skeleton():
-    tree = ET.parse(os.path.join(os.path.dirname(os.path.realpath(__file__)), "character/avatar_skeleton.xml"))
-    root = tree.getroot()
-    def getRecursive(bone, parent=None):
-        result = []
+    #Legacy dict form, built from the shared table in sl_skeleton_table
+    skeleton = sl_skeleton_table.loadSkeleton()
+    result = []
+    for bone in skeleton:
         entry = {
-            "name": bone.attrib["name"],
-            "group": bone.attrib["group"],
-            "pos_orig": [float(i) for i in bone.attrib["pos"].split(" ")],
-            "end_orig": [float(i) for i in bone.attrib["end"].split(" ")],
-            "rot_orig": [float(i) for i in bone.attrib["rot"].split(" ")],
-            "scale_orig": [float(i) for i in bone.attrib["scale"].split(" ")],
-            "parent": parent["name"] if parent else False,
-            "connected": bone.attrib.get("connected", "false").lower() == "true",
-            "type": bone.tag
+            "name": bone.name,
+            "group": bone.group,
+            "pos_orig": list(bone.pos_orig),
+            "end_orig": list(bone.end_orig),
+            "rot_orig": list(bone.rot_orig),
+            "scale_orig": list(bone.scale_orig),
+            "parent": skeleton.parentName(bone) or False,
+            "connected": bone.connected,
+            "support": bone.support,
+            "type": bone.type,
+            "pos": list(bone.pos),
+            "end": list(bone.end)
         }
         
-        if parent:
-            offset = parent["pos"]
-            entry["pos"] = [entry["pos_orig"][i]+offset[i] for i in range(0,3)]
-        else:
-            entry["pos"] = entry["pos_orig"]
-        entry["end"] = [entry["end_orig"][i]+entry["pos"][i] for i in range(0,3)]
-        
         entry["scale"] = mathutils.Matrix.Scale(entry["scale_orig"][0], 4, (1,0,0))
         entry["scale"] *= mathutils.Matrix.Scale(entry["scale_orig"][1], 4, (0,1,0))
         entry["scale"] *= mathutils.Matrix.Scale(entry["scale_orig"][2], 4, (0,0,1))
@@ -42,48 +40,160 @@ def get_skeleton():
         entry["rot"] = mathutils.Euler(entry["rot_orig"], "XYZ").to_matrix().to_4x4()
         
         result.append(entry)
-        
-        for child in bone:
-            result += getRecursive(child, parent=entry)
-        return result
-    return getRecursive(root[0])
+    return result
 
-def add_skeleton(self, context):
-    bones = get_skeleton()
+TEMPLATE_KEY = "plywood_skeleton_template"
+TEMPLATE_NAME = "SL Skeleton Template"
+SHAPEABLE_KEY = "plywood_shapeable"
+
+#Skeleton table each template armature was built from, reset on reload
+template_skeletons = {}
+
+def build_template(context, shapeable = False):
+    #Builds the armature once in edit mode, every rig after that is a copy
+    #Shapeable rigs have no connected bones, so pose location moves every
+    #joint, and don't inherit scale, the viewer doesn't pass joint scale on
+    bones = sl_skeleton_table.loadSkeleton()
+    kind = "shapeable" if shapeable else "default"
     
-    armature = bpy.data.armatures.new(name="Armature")
-    armature_obj = bpy.data.objects.new("Armature", armature)
+    armature = bpy.data.armatures.new(name=TEMPLATE_NAME)
+    armature_obj = bpy.data.objects.new(TEMPLATE_NAME, armature)
     context.collection.objects.link(armature_obj)
-    armature_obj.select_set(True)
+    active = context.view_layer.objects.active
     context.view_layer.objects.active = armature_obj
     bpy.ops.object.mode_set(mode='EDIT', toggle=False)
     edit_bones = armature.edit_bones
+    boners = [edit_bones.new(bone.name) for bone in bones]
+    edit_bones.foreach_set("head", [v for bone in bones for v in bone.pos])
+    edit_bones.foreach_set("tail", [v for bone in bones for v in bone.end])
+    for bone, b in zip(bones, boners):
+        if bone.parent >= 0:
+            b.parent = boners[bone.parent]
+        if shapeable:
+            b.inherit_scale = 'NONE'
+    edit_bones.foreach_set("use_connect", [bone.connected and not shapeable for bone in bones])
+    bpy.ops.object.mode_set(mode='OBJECT', toggle=False)
+    
     pose = armature_obj.pose
-    boners = {}
-    for bone in bones:
-        b = edit_bones.new(bone["name"])
-        boners[bone["name"]] = b
-        b.head = bone["pos"]
-        b.tail = bone["end"]
-        if bone["parent"]:
-            b.parent = boners[bone["parent"]]
-        
-        if bone["connected"]:
-            b.use_connect = True
+    groups = {"bone": pose.bone_groups.new(name="bone")}
+    groups["collision_volume"] = pose.bone_groups.new(name="collision_volume")
+    groups["collision_volume"].color_set = "THEME01"
+    for bone, pose_bone in zip(bones, pose.bones):
+        pose_bone.bone_group = groups[bone.type]
+    
+    context.collection.objects.unlink(armature_obj)
+    context.view_layer.objects.active = active
+    armature_obj[TEMPLATE_KEY] = kind
+    if shapeable:
+        armature_obj[SHAPEABLE_KEY] = True
+    armature_obj.use_fake_user = True
+    return armature_obj
+
+def get_template(context, shapeable = False):
+    kind = "shapeable" if shapeable else "default"
+    skeleton = sl_skeleton_table.loadSkeleton()
+    template = next((obj for obj in bpy.data.objects if obj.get(TEMPLATE_KEY) == kind), None)
+    if template is not None and template_skeletons.get(kind) is skeleton:
+        return template
     
-    #Remove auto-created bone
-    bpy.ops.object.mode_set(mode='EDIT',toggle=True)
-    pose.bone_groups.new(name="bone")
-    pose.bone_groups.new(name="collision_volume")
-    pose.bone_groups["collision_volume"].color_set = "THEME01"
-    bone_matrix = {}
-    for bone in bones:
-        pose.bones[bone["name"]].bone_group = pose.bone_groups[bone["type"]]
-        bone_matrix[bone["name"]] = armature.bones[bone["name"]].matrix_local
+    if template is not None:
+        armature = template.data
+        bpy.data.objects.remove(template)
+        if armature.users == 0:
+            bpy.data.armatures.remove(armature)
     
-    armature_obj.location = (0,0,0)
+    template = build_template(context, shapeable)
+    template_skeletons[kind] = skeleton
+    return template
+
+def make_shapeable(context, armature_obj):
+    #Same bone setup as a shapeable template, for rigs made without one
+    active = context.view_layer.objects.active
+    context.view_layer.objects.active = armature_obj
+    mode = armature_obj.mode
+    bpy.ops.object.mode_set(mode='EDIT', toggle=False)
+    for b in armature_obj.data.edit_bones:
+        b.use_connect = False
+        b.inherit_scale = 'NONE'
+    bpy.ops.object.mode_set(mode=mode, toggle=False)
+    context.view_layer.objects.active = active
+    armature_obj[SHAPEABLE_KEY] = True
+
+def new_skeleton(context, template, location = (0,0,0)):
+    #Copies the template object, which brings its pose and bone groups along
+    armature_obj = template.copy()
+    armature_obj.data = template.data.copy()
+    armature_obj.data.name = "Armature"
+    armature_obj.name = "Armature"
+    armature_obj.use_fake_user = False
+    del armature_obj[TEMPLATE_KEY]
+    armature_obj.location = location
+    context.collection.objects.link(armature_obj)
+    return armature_obj
+
+def add_skeleton(self, context):
+    armature_obj = new_skeleton(context, get_template(context))
+    for obj in context.selected_objects:
+        obj.select_set(False)
+    armature_obj.select_set(True)
+    context.view_layer.objects.active = armature_obj
+    
+    bone_matrix = {bone.name: bone.matrix_local for bone in armature_obj.data.bones}
     return armature_obj, bone_matrix
 
+def add_skeletons(context, count, spacing = 1.0, location = (0,0,0), shapeable = False):
+    #Places count rigs in a square grid starting at location
+    template = get_template(context, shapeable)
+    columns = max(1, math.ceil(math.sqrt(count)))
+    rigs = []
+    for i in range(count):
+        row, column = divmod(i, columns)
+        offset = (location[0] + column * spacing, location[1] + row * spacing, location[2])
+        rigs.append(new_skeleton(context, template, offset))
+    
+    for obj in context.selected_objects:
+        obj.select_set(False)
+    for rig in rigs:
+        rig.select_set(True)
+    if rigs:
+        context.view_layer.objects.active = rigs[-1]
+    return rigs
+
+def apply_shape(armature_obj, scales, positions):
+    #Poses every bone from evaluated joint scales and positions in one pass,
+    #see sl_shape.SkeletonShapeEngine.evaluate
+    if not armature_obj.get(SHAPEABLE_KEY):
+        make_shapeable(bpy.context, armature_obj)
+    arrays = sl_skeleton_table.loadSkeletonArrays()
+    bones = armature_obj.data.bones
+    pose_bones = armature_obj.pose.bones
+    order = np.array([arrays.index[b.name] for b in pose_bones], dtype=np.intp)
+    
+    #Rest rotation of each pose bone, the joints themselves are unrotated so the
+    #deltas are in armature axes and get turned into each bone's local axes
+    rest = np.empty(len(bones) * 16, dtype=np.float32)
+    bones.foreach_get("matrix_local", rest)
+    rest = rest.reshape(-1, 4, 4).transpose(0, 2, 1)[:, :3, :3]
+    names = {b.name:i for i, b in enumerate(bones)}
+    inverse = rest[[names[b.name] for b in pose_bones]].transpose(0, 2, 1)
+    
+    #Blender scales a child's location by its parent's pose scale without
+    #passing the scale itself on, which is how the viewer's joints work too
+    offsets = np.asarray(positions)[order] - arrays.positions[order]
+    factors = np.asarray(scales)[order] / arrays.scales[order]
+    location = np.einsum("nij,nj->ni", inverse, offsets)
+    #Exact for bones lying along an armature axis, which all the SL bones do
+    scale = np.einsum("nij,nj->ni", np.abs(inverse), factors)
+    
+    pose_bones.foreach_set("location", location.astype(np.float32).ravel())
+    pose_bones.foreach_set("scale", scale.astype(np.float32).ravel())
+    armature_obj.update_tag()
+
+def apply_shapes(rigs, scales, positions):
+    #scales and positions stacked along the first axis, one entry per rig
+    for rig, rig_scales, rig_positions in zip(rigs, scales, positions):
+        apply_shape(rig, rig_scales, rig_positions)
+
 #==============================================================================
 # Blender Operator class
 #==============================================================================
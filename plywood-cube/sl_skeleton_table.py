@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+import os
+import json
+import types
+import collections
+import xml.etree.ElementTree as ET
+import numpy as np
+try:
+    from . import sl_cache
+except ImportError:
+    #Run on its own, outside the add-on
+    import sl_cache
+
+skeleton_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "character", "avatar_skeleton.xml")
+
+PRECOMPILED_VERSION = 1
+
+#parent is the index of the parent bone, -1 for the root
+#pos and end are pos_orig and end_orig offset by the parent's pos
+SkeletonBone = collections.namedtuple("SkeletonBone", (
+    "name", "parent", "group", "type", "connected", "support",
+    "pos_orig", "end_orig", "rot_orig", "scale_orig", "pos", "end"
+))
+
+class SkeletonError(Exception):
+    pass
+
+class Skeleton:
+    #Immutable, bones are in depth first order so parents come before children
+    __slots__ = ("bones", "index")
+    
+    def __init__(self, bones):
+        self.bones = tuple(bones)
+        self.index = types.MappingProxyType({b.name:i for i, b in enumerate(self.bones)})
+    
+    def __len__(self):
+        return len(self.bones)
+    
+    def __iter__(self):
+        return iter(self.bones)
+    
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.bones[self.index[key]]
+        return self.bones[key]
+    
+    def parentName(self, bone):
+        if bone.parent < 0:
+            return None
+        return self.bones[bone.parent].name
+
+def parseVector(value):
+    return tuple(float(i) for i in value.split())
+
+def parseSkeleton(path = skeleton_path):
+    root = ET.parse(path).getroot()
+    if not len(root):
+        raise SkeletonError("Empty skeleton!")
+    
+    bones = []
+    def getRecursive(element, parent):
+        pos_orig = parseVector(element.attrib["pos"])
+        end_orig = parseVector(element.attrib["end"])
+        if parent >= 0:
+            offset = bones[parent].pos
+            pos = tuple(pos_orig[i] + offset[i] for i in range(0, 3))
+        else:
+            pos = pos_orig
+        
+        index = len(bones)
+        bones.append(SkeletonBone(
+            name = element.attrib["name"],
+            parent = parent,
+            group = element.attrib["group"],
+            type = element.tag,
+            connected = element.attrib.get("connected", "false").lower() == "true",
+            support = element.attrib.get("support", "base"),
+            pos_orig = pos_orig,
+            end_orig = end_orig,
+            rot_orig = parseVector(element.attrib["rot"]),
+            scale_orig = parseVector(element.attrib["scale"]),
+            pos = pos,
+            end = tuple(end_orig[i] + pos[i] for i in range(0, 3))
+        ))
+        
+        for child in element:
+            getRecursive(child, index)
+    
+    getRecursive(root[0], -1)
+    return Skeleton(bones)
+
+def savePrecompiled(skeleton, path, stamp):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temp = "{}.{}.tmp".format(path, os.getpid())
+    with open(temp, "w") as f:
+        json.dump({
+            "version": PRECOMPILED_VERSION,
+            "stamp": stamp,
+            "fields": SkeletonBone._fields,
+            "bones": skeleton.bones
+        }, f)
+    os.replace(temp, path)
+
+def loadPrecompiled(path, stamp):
+    with open(path, "r") as f:
+        data = json.load(f)
+    
+    if data["version"] != PRECOMPILED_VERSION or data["stamp"] != list(stamp) \
+     or data["fields"] != list(SkeletonBone._fields):
+        return None
+    
+    return Skeleton(SkeletonBone(*(tuple(v) if isinstance(v, list) else v
+        for v in bone)) for bone in data["bones"])
+
+loaded = sl_cache.Memo()
+
+def loadSkeleton(path = skeleton_path, precompiled = None):
+    #Parsed once and shared, parsed again only when the file changes
+    #If precompiled is a path the parsed table is also kept there
+    stamp = sl_cache.fileStamp(path)
+    return loaded.get(path, stamp, lambda: buildSkeleton(path, precompiled, stamp))
+
+def buildSkeleton(path, precompiled, stamp):
+    skeleton = None
+    if precompiled:
+        try:
+            skeleton = loadPrecompiled(precompiled, stamp)
+        except (OSError, ValueError, KeyError, TypeError):
+            skeleton = None
+    
+    if skeleton is None:
+        skeleton = parseSkeleton(path)
+        if precompiled:
+            try:
+                savePrecompiled(skeleton, precompiled, stamp)
+            except OSError:
+                pass
+    
+    return skeleton
+
+def eulerMatrices(angles):
+    #XYZ euler angles in radians to rotation matrices, shape (..., 3) to (..., 3, 3)
+    angles = np.asarray(angles, np.float64)
+    sx, sy, sz = np.moveaxis(np.sin(angles), -1, 0)
+    cx, cy, cz = np.moveaxis(np.cos(angles), -1, 0)
+    
+    result = np.empty(angles.shape[:-1] + (3, 3))
+    result[..., 0, 0] = cy * cz
+    result[..., 0, 1] = sx * sy * cz - cx * sz
+    result[..., 0, 2] = cx * sy * cz + sx * sz
+    result[..., 1, 0] = cy * sz
+    result[..., 1, 1] = sx * sy * sz + cx * cz
+    result[..., 1, 2] = cx * sy * sz - sx * cz
+    result[..., 2, 0] = -sy
+    result[..., 2, 1] = sx * cy
+    result[..., 2, 2] = cx * cy
+    return result
+
+def readOnly(array):
+    array.setflags(write=False)
+    return array
+
+class SkeletonArrays:
+    #Flat array form of a Skeleton for batched forward kinematics
+    #Everything is indexed like Skeleton.bones and parents come before children,
+    #levels holds the bone indices at each depth below the root
+    __slots__ = ("names", "index", "parents", "levels", "positions", "rotations", "scales")
+    
+    def __init__(self, skeleton):
+        self.names = tuple(b.name for b in skeleton)
+        self.index = skeleton.index
+        self.parents = readOnly(np.array([b.parent for b in skeleton], dtype=np.intp))
+        
+        depth = np.zeros(len(self.parents), dtype=np.intp)
+        for i, parent in enumerate(self.parents):
+            if parent >= 0:
+                depth[i] = depth[parent] + 1
+        self.levels = tuple(readOnly(np.flatnonzero(depth == d)) for d in range(1, depth.max(initial=0) + 1))
+        
+        #rot is in degrees like the viewer reads it
+        self.positions = readOnly(np.array([b.pos_orig for b in skeleton], dtype=np.float64))
+        self.rotations = readOnly(eulerMatrices(np.radians([b.rot_orig for b in skeleton])))
+        self.scales = readOnly(np.array([b.scale_orig for b in skeleton], dtype=np.float64))
+    
+    def __len__(self):
+        return len(self.names)
+    
+    def localMatrices(self, positions = None, rotations = None, scales = None):
+        #Local T * R * S matrices, any argument may carry leading batch dimensions
+        positions = self.positions if positions is None else np.asarray(positions, np.float64)
+        rotations = self.rotations if rotations is None else np.asarray(rotations, np.float64)
+        scales = self.scales if scales is None else np.asarray(scales, np.float64)
+        
+        shape = np.broadcast_shapes(positions.shape[:-1], rotations.shape[:-2], scales.shape[:-1])
+        result = np.zeros(shape + (4, 4))
+        result[..., :3, :3] = rotations * scales[..., None, :]
+        result[..., :3, 3] = positions
+        result[..., 3, 3] = 1.0
+        return result
+    
+    def worldMatrices(self, local = None):
+        #Forward kinematics one level at a time, each level is a single batched matmul
+        world = self.localMatrices() if local is None else np.array(local, np.float64)
+        for level in self.levels:
+            world[..., level, :, :] = world[..., self.parents[level], :, :] @ world[..., level, :, :]
+        return world
+    
+    def worldPositions(self, local = None):
+        return self.worldMatrices(local)[..., :3, 3]
+
+loadedArrays = sl_cache.Memo()
+
+def loadSkeletonArrays(path = skeleton_path, precompiled = None):
+    #Shared like loadSkeleton, rebuilt whenever the table is
+    skeleton = loadSkeleton(path, precompiled)
+    return loadedArrays.get(path, skeleton, lambda: SkeletonArrays(skeleton))
+
+if __name__ == "__main__":
+    import timeit
+    
+    skeleton = loadSkeleton()
+    arrays = loadSkeletonArrays()
+    world = arrays.worldPositions()
+    expected = np.array([b.pos for b in skeleton])
+    print("{} bones in {} levels, positions match: {}".format(
+        len(arrays), len(arrays.levels), np.allclose(world, expected)))
+    
+    count = 1000
+    seconds = timeit.timeit(arrays.worldMatrices, number=count)
+    print("worldMatrices: {:.1f}us".format(seconds / count * 1e6))
+    
+    local = np.broadcast_to(arrays.localMatrices(), (64, len(arrays), 4, 4))
+    seconds = timeit.timeit(lambda: arrays.worldMatrices(local), number=100)
+    print("worldMatrices x64: {:.1f}us".format(seconds / 100 * 1e6))